@@ -4,7 +4,7 @@ from __future__ import print_function
 import numpy as np
 from matplotlib import pyplot as plt
 import matplotlib.patches as patches
-import pydicom, os
+import pydicom, os, json, hashlib, socket, time, fnmatch, threading, queue
 
 try:
     from tkinter import *
@@ -180,6 +180,28 @@ class Options():
         self.dataFolder = StringVar(value = ".")
         self.VxList = StringVar(value="20 50 60 70")
         self.DxList = StringVar(value="5 20 50")
+        self.gEUDList = StringVar(value="1") # n values, empty -> no gEUD
+        self.prescribedDose = DoubleVar(value = 0) # Gy, 0 -> no conformity index
+        self.externalStructure = StringVar(value = "BODY")
+        self.extendedMetrics = IntVar(value = 0) # [ 0, 1 ]
+        self.doseSampling = StringVar(value = 'voxel') # [ 'voxel', 'interpolated' ]
+        self.zSubsampling = IntVar(value = 1) # 1 -> 5
+        self.endCapping = StringVar(value = 'half') # [ 'none', 'half', 'full' ]
+        self.useCache = IntVar(value = 0) # [ 0, 1 ]
+        self.cacheSize = DoubleVar(value = 2) # GB
+        self.memoryLimit = IntVar(value = 0) # MB, 0 -> keep the whole dose grid in memory
+        self.resumeBatch = IntVar(value = 0) # [ 0, 1 ]
+        self.manifestFile = StringVar(value = "output/manifest.json")
+        self.includeStructures = StringVar(value = "") # name patterns, empty -> all
+        self.excludeStructures = StringVar(value = "") # name patterns
+        self.structureTypes = StringVar(value = "") # RT ROI Interpreted Types, empty -> all
+        self.readerThreads = IntVar(value = 2) # 0 -> read, calculate and write one pair at a time
+        self.prefetchDepth = IntVar(value = 2) # loaded pairs waiting for the calculation
+        self.writeQueueDepth = IntVar(value = 4) # calculated pairs waiting to be written
+        self.prefetchMemory = IntVar(value = 2048) # MB
+        self.hotPairs = IntVar(value = 1) # loaded RD/RS pairs kept in memory between commands
+        self.beamDVH = IntVar(value = 0) # [ 0, 1 ]
+        self.contourTolerance = DoubleVar(value = 0) # fraction of the dose pixel size, 0 -> contours used as they are
 
         self.structureVariable = dict() # to be filled per instance
         self.maxDose = 100 # to be filled per instance
@@ -192,7 +214,29 @@ class Options():
                      'refineDoseMesh'       : self.refineDoseMesh,
                      'dataFolder'           : self.dataFolder,
                      'VxList'               : self.VxList,
-                     'DxList'               : self.DxList }
+                     'DxList'               : self.DxList,
+                     'gEUDList'             : self.gEUDList,
+                     'prescribedDose'       : self.prescribedDose,
+                     'externalStructure'    : self.externalStructure,
+                     'extendedMetrics'      : self.extendedMetrics,
+                     'doseSampling'         : self.doseSampling,
+                     'zSubsampling'         : self.zSubsampling,
+                     'endCapping'           : self.endCapping,
+                     'useCache'             : self.useCache,
+                     'cacheSize'            : self.cacheSize,
+                     'memoryLimit'          : self.memoryLimit,
+                     'resumeBatch'          : self.resumeBatch,
+                     'manifestFile'         : self.manifestFile,
+                     'includeStructures'    : self.includeStructures,
+                     'excludeStructures'    : self.excludeStructures,
+                     'structureTypes'       : self.structureTypes,
+                     'readerThreads'        : self.readerThreads,
+                     'prefetchDepth'        : self.prefetchDepth,
+                     'writeQueueDepth'      : self.writeQueueDepth,
+                     'prefetchMemory'       : self.prefetchMemory,
+                     'hotPairs'             : self.hotPairs,
+                     'beamDVH'              : self.beamDVH,
+                     'contourTolerance'     : self.contourTolerance }
 
     def loadOptions(self):
         read = False
@@ -232,6 +276,8 @@ class MainMenu(Frame):
             os.makedirs("output")
 
         self.structureCheckbutton = dict()
+        self.imagePair = list() # SeriesHandle per RD/RS pair
+        self.seriesPool = SeriesPool(self.options.hotPairs.get())
 
         self.upperContainer = Frame(self, bd=5, relief=RIDGE, height=40)  # Title
         self.middleContainer = Frame(self, bd=5)
@@ -262,6 +308,21 @@ class MainMenu(Frame):
         self.refineDoseMeshContainer = Frame(self.middleLeftLowerContainer)
         self.VxListContainer = Frame(self.middleLeftLowerContainer)
         self.DxListContainer = Frame(self.middleLeftLowerContainer)
+        self.extendedMetricsContainer = Frame(self.middleLeftLowerContainer)
+        self.gEUDListContainer = Frame(self.middleLeftLowerContainer)
+        self.prescribedDoseContainer = Frame(self.middleLeftLowerContainer)
+        self.doseSamplingContainer = Frame(self.middleLeftLowerContainer)
+        self.zSubsamplingContainer = Frame(self.middleLeftLowerContainer)
+        self.endCappingContainer = Frame(self.middleLeftLowerContainer)
+        self.cacheContainer = Frame(self.middleLeftLowerContainer)
+        self.memoryLimitContainer = Frame(self.middleLeftLowerContainer)
+        self.resumeBatchContainer = Frame(self.middleLeftLowerContainer)
+        self.structureFilterContainer = Frame(self.middleLeftLowerContainer)
+        self.structureTypesContainer = Frame(self.middleLeftLowerContainer)
+        self.prefetchContainer = Frame(self.middleLeftLowerContainer)
+        self.hotPairsContainer = Frame(self.middleLeftLowerContainer)
+        self.beamDVHContainer = Frame(self.middleLeftLowerContainer)
+        self.contourToleranceContainer = Frame(self.middleLeftLowerContainer)
         self.structureActionContainer = Frame(self.middleRightLowerContainer)
 
         self.upperContainer.pack(fill=X)
@@ -330,25 +391,160 @@ class MainMenu(Frame):
         for mode in range(1,6):
             Radiobutton(self.refineDoseMeshContainer, text=mode, variable=self.options.refineDoseMesh, value=mode).pack(side=LEFT, anchor=W)
         Tooltip(self.refineDoseMeshContainer, text='During the dose summation, a ray tracing operation is performed to locate the RD voxels '
-                'inside each structure. With a factor 1, the actual voxels are each evaluated (a voxel is included if it includes the '
-                'structure delineation). At higher factors, each voxel is split in x/y by that factor, increasing the resolution -- '
+                'inside each structure. With a factor 1, the actual voxels are each evaluated (a voxel is included if its centre is inside '
+                'the structure delineation, holes are excluded). At higher factors, each voxel is split in x/y by that factor, increasing the resolution -- '
                 ' as well as the calculation time.', wraplength=self.wraplength)
 
+        self.doseSamplingContainer.pack(anchor=W)
+        Label(self.doseSamplingContainer, text='Dose sampling: ').pack(side=LEFT, anchor=W)
+        for mode in ['voxel', 'interpolated']:
+            Radiobutton(self.doseSamplingContainer, text=mode, variable=self.options.doseSampling, value=mode).pack(side=LEFT, anchor=W)
+        Tooltip(self.doseSamplingContainer, text='Voxel: the RD voxels inside each structure are used directly, on the planes of the '
+                'dose grid. Interpolated: the dose is trilinearly interpolated at the sub-voxel points given by the refinement factor '
+                'and the z subsampling, using the nearest contour plane of the structure. This is closer to how a TPS such as Eclipse '
+                'calculates its DVHs.', wraplength=self.wraplength)
+
+        self.zSubsamplingContainer.pack(anchor=W)
+        Label(self.zSubsamplingContainer, text='Z subsampling (interpolated): ').pack(side=LEFT, anchor=W)
+        for mode in range(1,6):
+            Radiobutton(self.zSubsamplingContainer, text=mode, variable=self.options.zSubsampling, value=mode).pack(side=LEFT, anchor=W)
+        Tooltip(self.zSubsamplingContainer, text='Number of sampling planes per dose slice in the interpolated mode.', wraplength=self.wraplength)
+
+        self.endCappingContainer.pack(anchor=W)
+        Label(self.endCappingContainer, text='End capping (interpolated): ').pack(side=LEFT, anchor=W)
+        for mode in ['none', 'half', 'full']:
+            Radiobutton(self.endCappingContainer, text=mode, variable=self.options.endCapping, value=mode).pack(side=LEFT, anchor=W)
+        Tooltip(self.endCappingContainer, text='How far a structure extends beyond its first and last contour in the interpolated mode: '
+                'not at all, half a contour slice (as for all the other contours) or a full contour slice.', wraplength=self.wraplength)
+
+        self.cacheContainer.pack(anchor=W)
+        Label(self.cacheContainer, text='Cache decoded files: ').pack(side=LEFT, anchor=W)
+        for text, mode in [['Yes', 1], ['No', 0]]:
+            Radiobutton(self.cacheContainer, text=text, variable=self.options.useCache, value=mode).pack(side=LEFT, anchor=W)
+        Label(self.cacheContainer, text=' max [GB]: ').pack(side=LEFT, anchor=W)
+        Entry(self.cacheContainer, textvariable=self.options.cacheSize, width=5).pack(side=LEFT)
+        Tooltip(self.cacheContainer, text='Store the decoded dose grids and structure contours in the \'cache\' folder, so that '
+                'unchanged RD/RS files are not decoded again the next time they are loaded. The least recently used files are '
+                'removed when the cache grows beyond the maximum size.', wraplength=self.wraplength)
+
+        self.memoryLimitContainer.pack(anchor=W)
+        Label(self.memoryLimitContainer, text='Dose grid memory limit [MB]: ').pack(side=LEFT, anchor=W)
+        Entry(self.memoryLimitContainer, textvariable=self.options.memoryLimit, width=5).pack(side=LEFT)
+        Tooltip(self.memoryLimitContainer, text='With 0, the whole dose grid is decoded into memory. Otherwise the dose grid is read '
+                'from the RD file in slabs of slices that fit within this limit, for very large dose grids. The DVHs are identical. '
+                'Beam doses that are summed into a plan dose are read and summed slab by slab as well.',
+                wraplength=self.wraplength)
+
+        self.resumeBatchContainer.pack(anchor=W)
+        Label(self.resumeBatchContainer, text='Resumable batch run: ').pack(side=LEFT, anchor=W)
+        for text, mode in [['Yes', 1], ['No', 0]]:
+            Radiobutton(self.resumeBatchContainer, text=text, variable=self.options.resumeBatch, value=mode).pack(side=LEFT, anchor=W)
+        Entry(self.resumeBatchContainer, textvariable=self.options.manifestFile, width=20).pack(side=LEFT)
+        Tooltip(self.resumeBatchContainer, text='Keep track of the saved RD/RS pairs in a job manifest file. Pairs that are already '
+                'saved, with unchanged files and options, are skipped when saving again, e.g. after a crash. Several instances of '
+                'the program (also on different machines) can save the same folder tree at the same time when they use the same '
+                'manifest file, each pair is then processed by one of them.', wraplength=self.wraplength)
+
+        self.structureFilterContainer.pack(anchor=W)
+        Label(self.structureFilterContainer, text='Structures: ').pack(side=LEFT, anchor=W)
+        Entry(self.structureFilterContainer, textvariable=self.options.includeStructures, width=10).pack(side=LEFT)
+        Label(self.structureFilterContainer, text=' except: ').pack(side=LEFT, anchor=W)
+        Entry(self.structureFilterContainer, textvariable=self.options.excludeStructures, width=10).pack(side=LEFT)
+        Tooltip(self.structureFilterContainer, text='Space-separated lists of structure name patterns (\'PTV* CTV* Rectum\', '
+                'with * and ? as wildcards, not case sensitive) to load and to leave out. Empty loads all structures. The '
+                'contours of the structures that are left out are not read when the RS files are loaded, which is faster for '
+                'structure sets with many helper structures. Applies to the next load.', wraplength=self.wraplength)
+
+        self.structureTypesContainer.pack(anchor=W)
+        Label(self.structureTypesContainer, text='Structure types: ').pack(side=LEFT, anchor=W)
+        Entry(self.structureTypesContainer, textvariable=self.options.structureTypes, width=20).pack(side=LEFT)
+        Tooltip(self.structureTypesContainer, text='Space-separated list of RT ROI Interpreted Types (\'PTV CTV GTV ORGAN '
+                'EXTERNAL\') to load, from the RT ROI Observations in the RS file. Empty loads all types. Structures without a '
+                'type are only loaded when this is empty.', wraplength=self.wraplength)
+
+        self.prefetchContainer.pack(anchor=W)
+        Label(self.prefetchContainer, text='Read ahead: threads ').pack(side=LEFT, anchor=W)
+        Entry(self.prefetchContainer, textvariable=self.options.readerThreads, width=2).pack(side=LEFT)
+        Label(self.prefetchContainer, text=' pairs ').pack(side=LEFT, anchor=W)
+        Entry(self.prefetchContainer, textvariable=self.options.prefetchDepth, width=2).pack(side=LEFT)
+        Label(self.prefetchContainer, text=' writes ').pack(side=LEFT, anchor=W)
+        Entry(self.prefetchContainer, textvariable=self.options.writeQueueDepth, width=2).pack(side=LEFT)
+        Label(self.prefetchContainer, text=' max [MB] ').pack(side=LEFT, anchor=W)
+        Entry(self.prefetchContainer, textvariable=self.options.prefetchMemory, width=5).pack(side=LEFT)
+        Tooltip(self.prefetchContainer, text='When saving the DVHs of many RD/RS pairs, the given number of threads read the '
+                'next pairs while the current pair is calculated, and the output files are written in the background. At '
+                'most \'pairs\' read pairs wait for the calculation and \'writes\' calculated pairs for the writing, and '
+                'no more pairs are read ahead when their dose grids would need more memory than the maximum. With 0 threads, '
+                'the pairs are read, calculated and written one at a time.', wraplength=self.wraplength)
+
+        self.hotPairsContainer.pack(anchor=W)
+        Label(self.hotPairsContainer, text='RD/RS pairs kept in memory: ').pack(side=LEFT, anchor=W)
+        Entry(self.hotPairsContainer, textvariable=self.options.hotPairs, width=3).pack(side=LEFT)
+        Tooltip(self.hotPairsContainer, text='Only the file names and DICOM headers of the loaded RD/RS pairs are kept, the dose '
+                'grid and contours of a pair are read when it is plotted or saved, and released afterwards. The given number '
+                'of most recently used pairs are kept in memory, so that plotting the same pair again does not read it again. '
+                'Applies to the next load.', wraplength=self.wraplength)
+
+        self.beamDVHContainer.pack(anchor=W)
+        Label(self.beamDVHContainer, text='Save per-beam DVHs: ').pack(side=LEFT, anchor=W)
+        for text, mode in [['Yes', 1], ['No', 0]]:
+            Radiobutton(self.beamDVHContainer, text=text, variable=self.options.beamDVH, value=mode).pack(side=LEFT, anchor=W)
+        Tooltip(self.beamDVHContainer, text='When a folder has one RD file per beam (Dose Summation Type BEAM) instead of a plan '
+                'dose, the beam doses referencing the same plan are summed into the plan dose, one RD file at a time. With '
+                '\'Yes\', the DVHs of each beam are saved as well (with _beam<number> in the file names, or _beamfile<n> for '
+                'beams without a unique beam number), calculated while the beam dose is read for the sum. The beam DVHs always '
+                'use voxel dose sampling.', wraplength=self.wraplength)
+
+        self.contourToleranceContainer.pack(anchor=W)
+        Label(self.contourToleranceContainer, text='Contour simplification [pixels]: ').pack(side=LEFT, anchor=W)
+        Entry(self.contourToleranceContainer, textvariable=self.options.contourTolerance, width=5).pack(side=LEFT)
+        Tooltip(self.contourToleranceContainer, text='With a tolerance above 0, the contour points that are closer than this '
+                'fraction of the dose pixel size to the simplified contour (Douglas-Peucker) are left out before the contours '
+                'are rasterized, which is faster for contours with many points (e.g. BODY). The contours in the RS file are not '
+                'changed. For each structure, the number of points and the change of the contour volume (from the contour '
+                'areas) are printed. 0.1 - 0.2 is usually safe. Applies to the next load.', wraplength=self.wraplength)
+
         self.VxListContainer.pack(anchor=W)
         Label(self.VxListContainer, text='Evaluate V[D1 D2 ... DN]Gy: ').pack(side=LEFT, anchor=W)
         Entry(self.VxListContainer, textvariable=self.options.VxList, width=15).pack(side=LEFT)
         Tooltip(self.VxListContainer, text='Input a space-separated list (\'10 50 60\') with dose [Gy] values to evaluate the '
                 'relative volume at. The final, slice-summed per-structure DVH curve is used for the calculation. '
-                'The output is given in the \'eclipse\' text output. For more advanced dose metrics, such as gEUD etc., '
-                'see the DVH Tool (v1.3) program by Helge Pettersen.', wraplength=self.wraplength)
+                'The output is given in the \'eclipse\' text output. For more advanced dose metrics, see the DVH Tool (v1.3) '
+                'program by Helge Pettersen.', wraplength=self.wraplength)
 
         self.DxListContainer.pack(anchor=W)
         Label(self.DxListContainer, text='Evaluate D[V1 V2 ... VN]%:   ').pack(side=LEFT, anchor=W)
         Entry(self.DxListContainer, textvariable=self.options.DxList, width=15).pack(side=LEFT)
         Tooltip(self.DxListContainer, text='Input a space-separated list (\'10 20 30\') with volume fraction [%] '
                 'values to evaluate the dose at. The final, slice-summed per-structure DVH curve is used for the calculation. '
-                'The output is given in the \'eclipse\' text output. For more advanced dose metrics, such as gEUD etc., '
-                'see the DVH Tool (v1.3) program by Helge Pettersen.', wraplength=self.wraplength)
+                'The output is given in the \'eclipse\' text output. For more advanced dose metrics, see the DVH Tool (v1.3) '
+                'program by Helge Pettersen.', wraplength=self.wraplength)
+
+        self.extendedMetricsContainer.pack(anchor=W)
+        Label(self.extendedMetricsContainer, text='Extended dose metrics: ').pack(side=LEFT, anchor=W)
+        for text, mode in [['Yes', 1], ['No', 0]]:
+            Radiobutton(self.extendedMetricsContainer, text=text, variable=self.options.extendedMetrics, value=mode).pack(side=LEFT, anchor=W)
+        Tooltip(self.extendedMetricsContainer, text='With \'Yes\', the min, max and mean dose, D2cc, the gEUD values, the '
+                'homogeneity index (D2% - D98%) / D50% and the conformity index are given for each structure in the \'eclipse\' '
+                'text output, after the D and V values. D2cc is n/a for structures smaller than 2 cc.', wraplength=self.wraplength)
+
+        self.gEUDListContainer.pack(anchor=W)
+        Label(self.gEUDListContainer, text='Evaluate gEUD[n1 n2 ... nN]:  ').pack(side=LEFT, anchor=W)
+        Entry(self.gEUDListContainer, textvariable=self.options.gEUDList, width=15).pack(side=LEFT)
+        Tooltip(self.gEUDListContainer, text='Input a space-separated list (\'0.1 1 10\') with volume effect parameters n to '
+                'evaluate the generalized equivalent uniform dose gEUD = (sum v_i D_i^(1/n))^n at. n = 1 gives the mean dose, '
+                'small n approach the maximum dose. Leave empty to skip. The output is given in the \'eclipse\' text output '
+                'with the extended dose metrics.', wraplength=self.wraplength)
+
+        self.prescribedDoseContainer.pack(anchor=W)
+        Label(self.prescribedDoseContainer, text='Prescribed dose [Gy]: ').pack(side=LEFT, anchor=W)
+        Entry(self.prescribedDoseContainer, textvariable=self.options.prescribedDose, width=5).pack(side=LEFT)
+        Label(self.prescribedDoseContainer, text=' external: ').pack(side=LEFT, anchor=W)
+        Entry(self.prescribedDoseContainer, textvariable=self.options.externalStructure, width=10).pack(side=LEFT)
+        Tooltip(self.prescribedDoseContainer, text='With a prescribed dose above 0 Gy, the Paddick conformity index '
+                'TV_PIV^2 / (TV * PIV) is given with the extended dose metrics. The prescription isodose volume '
+                'PIV is taken from the DVH of the external structure, which must be one of the selected structures.',
+                wraplength=self.wraplength)
 
         self.progress = ttk.Progressbar(self.middleRightUpperContainer, orient=HORIZONTAL, maximum=100, mode='determinate')
         self.progress.pack(fill=X, pady=3)
@@ -376,9 +572,14 @@ class MainMenu(Frame):
                                 command=self.plotDVHCommand, width=self.button_width, state=DISABLED)
         self.buttonSaveDVH = Button(self.bottomContainer1, text='Save DVH file(s)', command=self.saveDVHCommand,
                                     width=self.button_width, state=DISABLED)
+        self.buttonSaveSlicewiseDVH = Button(self.bottomContainer1, text='Save DVH per slice', command=self.saveSlicewiseDVHCommand,
+                                    width=self.button_width, state=DISABLED)
+        Tooltip(self.buttonSaveSlicewiseDVH, text='For each RD/RS pair, save the cumulative DVH of every slice of each structure '
+                'to output/<patient>_slicewise.npz, with the arrays \'dose\' [Gy], \'sliceZ\' [mm], \'structures\' and '
+                '\'dvh\' [cc] (structure x slice x dose bin).', wraplength=self.wraplength)
         self.buttonQuit = Button(self.bottomContainer1, text='Exit', command=self.myQuit, width=self.button_width)
 
-        for button in [self.buttonPlotRTDoseSlicewise, self.buttonPlotDVH, self.buttonSaveDVH, self.buttonQuit]:
+        for button in [self.buttonPlotRTDoseSlicewise, self.buttonPlotDVH, self.buttonSaveDVH, self.buttonSaveSlicewiseDVH, self.buttonQuit]:
             button.pack(side=LEFT, anchor=N, padx=5, pady=5)
 
         self.pack()
@@ -388,8 +589,31 @@ class MainMenu(Frame):
         self.parent.destroy()
         self.quit()
 
+    def getCache(self):
+        if self.options.useCache.get():
+            return DicomCache("cache", self.options.cacheSize.get() * 1e9)
+
+        return None
+
+    def getStructureFilter(self):
+        return StructureFilter(self.options.includeStructures.get(), self.options.excludeStructures.get(),
+                               self.options.structureTypes.get())
+
+    def getManifest(self, activeStructures):
+        if not self.options.resumeBatch.get():
+            return None
+
+        # The options that change the output files, a pair is processed again when these change
+        settings = { k : v.get() for k, v in self.options.vars.items() if k in ['DVHFileType', 'volumeType', 'doseSegmentation',
+                     'refineDoseMesh', 'VxList', 'DxList', 'gEUDList', 'prescribedDose', 'externalStructure', 'extendedMetrics',
+                     'doseSampling', 'zSubsampling', 'endCapping', 'beamDVH', 'contourTolerance'] }
+        settings['structures'] = sorted(activeStructures)
+
+        return JobManifest(self.options.manifestFile.get(), self.options.dataFolder.get(), settings)
+
     def loadFolderCommand(self):
         self.imagePair = []
+        self.seriesPool = SeriesPool(self.options.hotPairs.get())
 
         dataFolder = filedialog.askdirectory(title="Get root directory for RS/RD file pairs", initialdir=self.options.dataFolder.get())
         if not dataFolder:
@@ -400,32 +624,34 @@ class MainMenu(Frame):
         
         for root, d, f, in os.walk(dataFolder): # loop through folders
             RSfile = None
-            RDfile = None
+            RDfiles = list()
             try:
                 for filename in f: # loop through files
                     if 'RD' in filename:
-                        RDfile = f"{root}/{filename}"
+                        RDfiles.append(f"{root}/{filename}")
                     elif 'RS' in filename:
                         RSfile = f"{root}/{filename}"
 
-                if not RSfile or not RDfile:
+                if not RSfile or not RDfiles:
                     continue
                 
-                self.imagePair.append(Series(rd=RDfile, rs=RSfile))
+                for RDfile in groupDoseFiles(RDfiles): # one plan dose, or a list of beam doses to sum
+                    self.imagePair.append(SeriesHandle(rd=RDfile, rs=RSfile, cache=self.getCache(),
+                                                       memoryLimit=self.options.memoryLimit.get(),
+                                                       structureFilter=self.getStructureFilter(),
+                                                       contourTolerance=self.options.contourTolerance.get()))
 
             except Exception as e:
                 print(f"Could not process RD/RS files in {root}: {e}")
 
+        setOutputNames(self.imagePair)
         print(f"Loading structures from {len(self.imagePair)} RD/RS pairs...")
         idx_sum = 0
-        nStructures = 0
-        for imagePair in self.imagePair:
-            nStructures += len(imagePair.rs.ROIContourSequence)
-            
-        self.progress['maximum'] = nStructures
+        self.progress['maximum'] = len(self.imagePair)
         
         for imagePair in self.imagePair:
-            imagePair.loadStructures(self.progress)
+            self.progress.step(1)
+            self.progress.update_idletasks()
 
             structureContainer = [self.middleRightLowerLeftContainer,
                                   self.middleRightLowerMiddleContainer,
@@ -447,6 +673,7 @@ class MainMenu(Frame):
             self.buttonPlotDVH['state'] = 'normal'
             self.buttonPlotRTDoseSlicewise['state'] = 'normal'
             self.buttonSaveDVH['state'] = 'normal'
+            self.buttonSaveSlicewiseDVH['state'] = 'normal'
 
         self.progress['value'] = 0
 
@@ -460,23 +687,25 @@ class MainMenu(Frame):
 
         try:
             RSfile = None
-            RDfile = None
+            RDfiles = list()
             for file in fileList:
                 if 'RD' in file:
-                    RDfile = file
+                    RDfiles.append(file)
 
                 elif 'RS' in file:
                     RSfile = file
 
-            if not RSfile or not RDfile:
+            if not RSfile or not RDfiles:
                 print("Could not identify files, try naming then with \'RS\' and \'RD\' in filename")
                 return
 
-            self.imagePair = [Series(rd=RDfile, rs=RSfile)]
-
-            self.progress['maximum'] = len(self.imagePair[0].rs.ROIContourSequence)
-            
-            self.imagePair[0].loadStructures(self.progress)
+            self.imagePair = [SeriesHandle(rd=RDfile, rs=RSfile, cache=self.getCache(), memoryLimit=self.options.memoryLimit.get(),
+                                           structureFilter=self.getStructureFilter(),
+                                           contourTolerance=self.options.contourTolerance.get()) for RDfile in groupDoseFiles(RDfiles)]
+            if not self.imagePair:
+                return
+            setOutputNames(self.imagePair)
+            self.seriesPool = SeriesPool(self.options.hotPairs.get())
 
             structureContainer = [self.middleRightLowerLeftContainer,
                                   self.middleRightLowerMiddleContainer,
@@ -494,16 +723,39 @@ class MainMenu(Frame):
             self.buttonPlotDVH['state'] = 'normal'
             self.buttonPlotRTDoseSlicewise['state'] = 'normal'
             self.buttonSaveDVH['state'] = 'normal'
+            self.buttonSaveSlicewiseDVH['state'] = 'normal'
             
         except Exception as e:
             print("Could not read files, aborting.",)
             print(f"Error message: {e}")
             return
 
+    def calculateStructureVolumes(self, imagePair, activeStructures):
+        # Returns the dose bins and a DVHAccumulator for each active structure in an RD/RS pair
+        img = imagePair.getDoseImage()
+        sh = np.shape(img)
+
+        maxDose = imagePair.maxDose
+        self.options.maxDose = maxDose
+
+        dose = np.arange(0, maxDose, self.options.doseSegmentation.get())
+
+        if self.options.doseSampling.get() == 'interpolated':
+            structureDVH = dict()
+            for structure in activeStructures:
+                self.progress.step(sh[0])
+                self.progress.update_idletasks()
+                structureDVH[structure] = imagePair.getInterpolatedDVH(structure, dose, self.options)
+
+            return dose, structureDVH
+
+        return dose, imagePair.getStructureDVHs(activeStructures, dose, self.options, progress=self.progress)
+
     def plotRTDoseSlicewiseCommand(self): # ONLY AVAILABLE WITH ONE RD/RS PAIR
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(20,10))
-        X = self.imagePair[0].getDoseImage()
-        tracker = IndexTracker(ax1, ax2, X, self.imagePair[0], self.options)
+        imagePair = self.seriesPool.get(self.imagePair[0])
+        X = imagePair.getDoseImage()
+        tracker = IndexTracker(ax1, ax2, X, imagePair, self.options)
         fig.canvas.mpl_connect('scroll_event', tracker.onscroll)
         plt.show()
 
@@ -511,45 +763,25 @@ class MainMenu(Frame):
         activeStructures = [k for k,v in self.options.structureVariable.items() if v.get()]
         self.progress['maximum'] = len(activeStructures) * sum([int(k.rd.NumberOfFrames) for k in self.imagePair])
         
-        for imagePair in self.imagePair:
-            img = imagePair.getDoseImage()
-            sh = np.shape(img)
-
-            maxDose = imagePair.maxDose
-            self.options.maxDose = maxDose
-
-
-            structureDose = dict()        
-            dose = np.arange(0, maxDose, self.options.doseSegmentation.get())
-            structureVolume = { s : np.zeros(dose.shape) for s in activeStructures }
-
-            for z in range(sh[0]):
-                for structure in activeStructures:
-                    self.progress.step(1)
-                    self.progress.update_idletasks()
-                    
-                    contours = imagePair.getStructuresInImageCoordinates(structure, z)
-                    for contourX, contourY in zip(*contours):
-                        linearContour = LinearContour(self.options)
-                        linearContour.addLines(np.dstack((contourX, contourY))[0])
-                        dose, structureVolume[structure] = linearContour.getDVH(img[z,:,:], imagePair.voxelVolume, structureVolume[structure])
+        for pairHandle in self.imagePair:
+            imagePair = self.seriesPool.get(pairHandle)
+            dose, structureDVH = self.calculateStructureVolumes(imagePair, activeStructures)
 
 
             fig = plt.figure()
             for structure in activeStructures:
                 if self.options.volumeType.get() == 'relative':
-                    if structureVolume[structure][0] > 0:
-                        structureVolume[structure] *= 100 / structureVolume[structure][0]
-                    else:
+                    if structureDVH[structure].getTotalVolume() == 0:
                         print(f"Cannot normalize volume for empty structure {structure}.")
+                    volume = structureDVH[structure].getRelativeVolume()
                     plt.ylabel("Volume [%]")
                 else:
-                    structureVolume[structure] *= cc
+                    volume = structureDVH[structure].getAbsoluteVolume()
                     plt.ylabel("Volume [cc]")
 
                 plt.title(f"DVH: PatientName: {imagePair.rs.PatientName}, PatientID: {imagePair.rs.PatientID}")
                 plt.xlabel("Dose [Gy]")
-                plt.plot(dose, structureVolume[structure], label=structure)
+                plt.plot(dose, volume, label=structure)
         
             plt.legend()
         self.progress['value'] = 0
@@ -557,92 +789,183 @@ class MainMenu(Frame):
         
 
     def saveDVHCommand(self):
-        nFiles = 0
         activeStructures = [k for k,v in self.options.structureVariable.items() if v.get()]
         self.progress['maximum'] = len(activeStructures) * sum([int(k.rd.NumberOfFrames) for k in self.imagePair])
 
-        for imagePair in self.imagePair:
-            img = imagePair.getDoseImage()
-            sh = np.shape(img)
+        manifest = self.getManifest(activeStructures)
+        if manifest:
+            manifest.addJobs([[imagePair.rdFilename, imagePair.rsFilename] + imagePair.beamFilenames[1:] for imagePair in self.imagePair])
+
+        # The pairs are read in reader threads, calculated here (with progress bar updates) and written in a writer thread
+        beamDVHStructures = self.options.beamDVH.get() and activeStructures or list()
+        doseSegmentation = self.options.doseSegmentation.get()
+
+        def loadPair(pairHandle):
+            if manifest and not manifest.claim(pairHandle.rdFilename, pairHandle.rsFilename, pairHandle.beamFilenames[1:]):
+                # already saved, or saved by another worker
+                return None
+            imagePair = self.seriesPool.get(pairHandle, beamDVHStructures, doseSegmentation, self.options)
+            imagePair.prefetch(activeStructures)
+            return imagePair
+
+        def calculatePair(imagePair, loadedPair):
+            if loadedPair is None:
+                self.progress.step(len(activeStructures) * int(imagePair.rd.NumberOfFrames))
+                return None
+            return self.getDVHFiles(loadedPair, activeStructures)
+
+        def writePair(imagePair, outputText):
+            if outputText is None:
+                return 0
+            outputFiles = self.writeDVHFiles(outputText)
+            if manifest:
+                manifest.complete(imagePair.rdFilename, outputFiles)
+            return len(outputFiles)
+
+        def failPair(imagePair, error):
+            print(f"Could not process {imagePair.rdFilename}: {error}")
+            if manifest:
+                manifest.fail(imagePair.rdFilename, str(error))
+
+        pipeline = Pipeline(loadPair, calculatePair, writePair, failPair, self.options.readerThreads.get(),
+                            self.options.prefetchDepth.get(), self.options.writeQueueDepth.get(),
+                            self.options.prefetchMemory.get() * 2**20, lambda pairHandle: pairHandle.getMemorySize())
+        nFiles = sum(pipeline.run(self.imagePair))
 
-            maxDose = imagePair.maxDose
-            self.options.maxDose = maxDose
+        s = nFiles>1 and "s" or ""
+        self.progress['value'] = 0
+        print(f"Saved {nFiles} file{s}.")
 
-            structureDose = dict()
-            dose = np.arange(0, maxDose, self.options.doseSegmentation.get())
-            structureVolume = { s : np.zeros(dose.shape) for s in activeStructures }
+    def writeDVHFiles(self, outputText):
+        # Writes { filename : text } from getDVHFiles, returns the list of written files
+        outputFiles = list()
+        for filename, text in outputText.items():
+            with open(filename, 'w') as outputFile:
+                outputFile.write(text)
+            outputFiles.append(filename)
 
-            for z in range(sh[0]):
-                for structure in activeStructures:
-                    self.progress.step(1)
-                    self.progress.update_idletasks()
+        return outputFiles
                     
-                    contours = imagePair.getStructuresInImageCoordinates(structure, z)
-                    for contourX, contourY in zip(*contours):
-                        linearContour = LinearContour(self.options)
-                        linearContour.addLines(np.dstack((contourX, contourY))[0])
-                        dose, structureVolume[structure] = linearContour.getDVH(img[z,:,:], imagePair.voxelVolume, structureVolume[structure])
+    def getDVHFiles(self, imagePair, activeStructures):
+        # Calculates the DVHs of one RD/RS pair, returns { filename : text } of the output files, including the
+        # per-beam DVHs made while summing the beam doses
+        dose, structureDVH = self.calculateStructureVolumes(imagePair, activeStructures)
+        outputText = self.formatDVHFiles(imagePair, activeStructures, dose, structureDVH)
+
+        for beamNumber, (beamDose, beamDVH) in imagePair.beamDVH.items():
+            outputText.update(self.formatDVHFiles(imagePair, activeStructures, beamDose, beamDVH, f"_beam{beamNumber}"))
+
+        return outputText
+
+    def formatDVHFiles(self, imagePair, activeStructures, dose, structureDVH, suffix = ""):
+        # Returns { filename : text } of the output files with the DVHs of an RD/RS pair
+        outputText = dict()
+        eclipse_output = ""
+
+        eclipse_output += f"Patient Name\t\t: {imagePair.rs.PatientName}\n"
+        eclipse_output += f"Patient ID\t\t: {imagePair.rs.PatientID}\n"
+        eclipse_output += f"Comment\t\t: Made by RD2DVH.py version {PROGRAM_VERSION} by Helge Pettersen\n"
+        eclipse_output += "Type\t\t: Cumulative Dose Volume Histogram\n"
+
+        # All dose metrics are evaluated at once, for all structures
+        DxList = [ float(k) for k in self.options.DxList.get().split() ]
+        VxList = [ float(k) for k in self.options.VxList.get().split() ]
+        gEUDList = [ float(k) for k in self.options.gEUDList.get().split() ]
+        metrics = DVHMetrics(dose, [structureDVH[structure].getCumulativeVolume() for structure in activeStructures])
+        DxListEvaluated = metrics.getDoseAtVolume(DxList)
+        VxListEvaluated = metrics.getVolumeAtDose(VxList)
+        gEUDEvaluated = metrics.getGEUD(gEUDList)
+        minDose, maxDose, meanDose = metrics.getMinDose(), metrics.getMaxDose(), metrics.getMeanDose()
+        D2cc = metrics.getDoseAtAbsoluteVolume([2])[:,0]
+        homogeneityIndex = metrics.getHomogeneityIndex()
+
+        conformityIndex = None
+        prescribedDose = self.options.prescribedDose.get()
+        externalStructure = self.options.externalStructure.get()
+        if prescribedDose > 0 and self.options.extendedMetrics.get():
+            if externalStructure in activeStructures:
+                conformityIndex = metrics.getConformityIndex(prescribedDose, activeStructures.index(externalStructure))
+            else:
+                print(f"Cannot calculate the conformity index without the external structure {externalStructure}.")
+
+        for structureIdx, structure in enumerate(activeStructures):
+            csv_output = ""
+            eclipse_output += f"\nStructure: {structure}\n"
+            eclipse_output += f"Approval Status: {imagePair.rs.ApprovalStatus}\n"
+            eclipse_output += f"Volume [cc]: {structureDVH[structure].getTotalVolume()*cc:.3f}\n"
+
+            if structureDVH[structure].getTotalVolume() > 0:
+                eclipse_output += "\n".join([f"D{Din}% = {Dout:.2f} Gy" for Din, Dout in zip(DxList, DxListEvaluated[structureIdx])])
+                eclipse_output += "\n"
+                eclipse_output += "\n".join([f"V{Vin} Gy = {Vout:.2f}%" for Vin, Vout in zip(VxList, VxListEvaluated[structureIdx])])
+                eclipse_output += "\n"
 
-            eclipse_output = ""
-                
-            eclipse_output += f"Patient Name\t\t: {imagePair.rs.PatientName}\n"
-            eclipse_output += f"Patient ID\t\t: {imagePair.rs.PatientID}\n"
-            eclipse_output += f"Comment\t\t: Made by RD2DVH.py version {PROGRAM_VERSION} by Helge Pettersen\n"
-            eclipse_output += "Type\t\t: Cumulative Dose Volume Histogram\n"
-            
-            for structure in activeStructures:
-                csv_output = ""
-                eclipse_output += f"\nStructure: {structure}\n"
-                eclipse_output += f"Approval Status: {imagePair.rs.ApprovalStatus}\n"
-                eclipse_output += f"Volume [cc]: {structureVolume[structure][0]*cc:.3f}\n"
-                
-                if structureVolume[structure][0] > 0:
-                    DxList = [ float(k) for k in self.options.DxList.get().split(" ") ]
-                    VxList = [ float(k) for k in self.options.VxList.get().split(" ") ]
+            if structureDVH[structure].getTotalVolume() > 0 and self.options.extendedMetrics.get():
+                # Appended after the D and V values, so that the default output format is unchanged
+                eclipse_output += f"Min Dose [Gy]: {minDose[structureIdx]:.3f}\n"
+                eclipse_output += f"Max Dose [Gy]: {maxDose[structureIdx]:.3f}\n"
+                eclipse_output += f"Mean Dose [Gy]: {meanDose[structureIdx]:.3f}\n"
+                if structureDVH[structure].getTotalVolume() * cc < 2:
+                    eclipse_output += "D2cc = n/a\n"
+                else:
+                    eclipse_output += f"D2cc = {D2cc[structureIdx]:.2f} Gy\n"
+                for n, gEUD in zip(gEUDList, gEUDEvaluated[structureIdx]):
+                    eclipse_output += f"gEUD(n={n}) = {gEUD:.2f} Gy\n"
+                eclipse_output += f"HI = {homogeneityIndex[structureIdx]:.3f}\n"
+                if conformityIndex is not None:
+                    eclipse_output += f"CI = {conformityIndex[structureIdx]:.3f}\n"
+
+            eclipse_output += "\n"
+            if self.options.volumeType.get() == 'relative':
+                if structureDVH[structure].getTotalVolume() > 0:
+                    volume = structureDVH[structure].getRelativeVolume()
+                    eclipse_output += "Dose [Gy]\t\tVolume [%]\n"
+                    csv_output += "Dose [Gy],Volume [%]\n"
+                else:
+                    print(f"Cannot normalize volume for empty structure {structure}.")
+                    volume = structureDVH[structure].getAbsoluteVolume()
+                    eclipse_output += "Dose [Gy]\t\tVolume [cc]\n"
+                    csv_output += "Dose [Gy],Volume [%]\n"
+            else:
+                volume = structureDVH[structure].getAbsoluteVolume()
+                eclipse_output += "Dose [Gy]\t\t\tVolume [cc]\n"
+                csv_output += "Dose [Gy],Volume [cc]\n"
 
-                    dvhCalculator = DVH(dose, structureVolume[structure], self.options)
-                    DxListEvaluated = [ dvhCalculator.getDoseAtVolume(k) for k in DxList ]
-                    VxListEvaluated = [ dvhCalculator.getVolumeAtDose(k) for k in VxList ]
-                
-                    eclipse_output += "\n".join([f"D{Din}% = {Dout:.2f} Gy" for Din, Dout in zip(DxList, DxListEvaluated)])
-                    eclipse_output += "\n"
-                    eclipse_output += "\n".join([f"V{Vin} Gy = {Vout:.2f}%" for Vin, Vout in zip(VxList, VxListEvaluated)])
-                    eclipse_output += "\n"
+            for line in zip(dose, volume):
+                eclipse_output += f"{float(line[0]):8.5f}\t\t{float(line[1]):8.5f}\n"
+                csv_output += f"{float(line[0]):8.5f},{float(line[1]):8.5f}\n"
 
-                eclipse_output += "\n"
-                if self.options.volumeType.get() == 'relative':
-                    if structureVolume[structure][0] > 0:
-                        structureVolume[structure] *= 100 / structureVolume[structure][0]
-                        eclipse_output += "Dose [Gy]\t\tVolume [%]\n"
-                        csv_output += "Dose [Gy],Volume [%]\n"
-                    else:
-                        print(f"Cannot normalize volume for empty structure {structure}.")
-                        structureVolume[structure] *= cc
-                        eclipse_output += "Dose [Gy]\t\tVolume [cc]\n"
-                        csv_output += "Dose [Gy],Volume [%]\n"
-                else:
-                    structureVolume[structure] *= cc
-                    eclipse_output += "Dose [Gy]\t\t\tVolume [cc]\n"
-                    csv_output += "Dose [Gy],Volume [cc]\n"
-                    
-                for line in zip(dose,structureVolume[structure]):
-                    eclipse_output += f"{float(line[0]):8.5f}\t\t{float(line[1]):8.5f}\n"
-                    csv_output += f"{float(line[0]):8.5f},{float(line[1]):8.5f}\n"
+            if self.options.DVHFileType.get() == "simple":
+                outputText[f"output/{imagePair.outputName}{suffix}_{structure}.csv"] = csv_output
 
-                if self.options.DVHFileType.get() == "simple":
-                    with open(f"output/{imagePair.rs.PatientName}_{structure}.csv", 'w') as csv_file:
-                        csv_file.write(csv_output)
-                        nFiles += 1
+        if self.options.DVHFileType.get() == "eclipse":
+            outputText[f"output/{imagePair.outputName}{suffix}.txt"] = eclipse_output
 
-            if self.options.DVHFileType.get() == "eclipse":
-                with open(f"output/{imagePair.rs.PatientName}.txt", 'w') as eclipse_file:
-                    eclipse_file.write(eclipse_output)
-                    nFiles += 1
+        return outputText
+
+    def saveSlicewiseDVHCommand(self):
+        nFiles = 0
+        activeStructures = [k for k,v in self.options.structureVariable.items() if v.get()]
+        self.progress['maximum'] = sum([int(k.rd.NumberOfFrames) for k in self.imagePair])
+
+        for pairHandle in self.imagePair:
+            imagePair = self.seriesPool.get(pairHandle)
+            self.options.maxDose = imagePair.maxDose
+            dose = np.arange(0, imagePair.maxDose, self.options.doseSegmentation.get())
+            slicewiseVolume = imagePair.getSlicewiseDVH(activeStructures, dose, self.options, self.progress)
+
+            sh = np.shape(imagePair.getDoseImage())
+            sliceZ = np.arange(sh[0]) * imagePair.sliceThickness + float(imagePair.rd.ImagePositionPatient[2])
+            dvh = np.array([slicewiseVolume[structure] * cc for structure in activeStructures], dtype=np.float32)
+
+            np.savez_compressed(f"output/{imagePair.outputName}_slicewise.npz", dose=dose, sliceZ=sliceZ,
+                                structures=np.array(activeStructures), dvh=dvh)
+            nFiles += 1
 
         s = nFiles>1 and "s" or ""
         self.progress['value'] = 0
         print(f"Saved {nFiles} file{s}.")
-                    
+
     def structureCheckAllCommand(self):
         for check in self.options.structureVariable.values():
             check.set(1)
@@ -652,22 +975,92 @@ class MainMenu(Frame):
             check.set(0)
 
 class IndexTracker(object):
-    def __init__(self, ax1, ax2, X, images, options):
+    # Slice-wise dose viewer. The contours of each slice are prepared once, the DVH of a slice is calculated on the
+    # first visit, and scrolling only swaps the data of persistent artists and blits them onto a saved background.
+    colors = ['r', 'g', 'b', 'y', 'c', 'm', 'orange', 'lightcoral',
+              'peachpuff', 'olive', 'gold', 'navy', 'sienna', 'tan', 'crimson',
+              'lime', 'goldenrod', 'moccasin', 'beige', 'tomato', 'mistyrose', 'darksalmon',
+              'navajowhite', 'darkorange', 'snow', 'teal', 'deeppink', 'orchid']
+
+    def __init__(self, ax1, ax2, X, images, options, maxDisplaySize = 512):
         self.ax1 = ax1
         self.ax2 = ax2
         self.images = images
         self.options = options
-        self.lines = list()
+        self.canvas = self.ax1.figure.canvas
+        self.background = None
         self.ax1.set_title('use scroll wheel to navigate images')
 
         self.X = X
-        self.slices, cols, rows = X.shape
+        self.slices, rows, cols = X.shape
         self.ind = self.slices//2
-        self.ind = 96
-        
-        self.im = self.ax1.imshow(self.X[self.ind, :, :], cmap="gray")
+
+        # Large frames are downsampled for display, the extent keeps the axes in (full) pixel coordinates
+        self.step = max(1, int(np.ceil(max(rows, cols) / maxDisplaySize)))
+        self.im = self.ax1.imshow(self.X[self.ind, ::self.step, ::self.step], cmap="gray", vmin=0, vmax=self.images.maxDose,
+                                  extent=(-0.5, cols-0.5, rows-0.5, -0.5), animated=True)
+        self.sliceText = self.ax1.text(0.02, 0.98, "", color="w", va="top", transform=self.ax1.transAxes, animated=True)
+
+        colStruct = dict(zip(self.images.listOfStructures, self.colors))
+        self.activeStructures = [k for k,v in self.options.structureVariable.items() if v.get()]
+        self.contourPaths = self.getContourPaths()
+        self.sliceDVH = dict()
+
+        self.contourLines, self.dvhLines = dict(), dict()
+        for structure in self.activeStructures:
+            self.contourLines[structure], = self.ax1.plot([], [], color=colStruct.get(structure), animated=True)
+            self.dvhLines[structure], = self.ax2.plot([], [], color=colStruct.get(structure), label=structure, animated=True)
+
+        self.ax2.set_xlim(0, self.images.maxDose)
+        self.ax2.set_xlabel(f"Dose [{self.images.rd[0x3004,0x2].value.capitalize()}]")
+        if self.options.volumeType.get() == 'absolute':
+            self.ax2.set_ylabel("Volume [cc]")
+            self.ax2.set_ylim(0, 1)
+        else:
+            self.ax2.set_ylabel("Volume [%]")
+            self.ax2.set_ylim(0, 105)
+        if self.activeStructures:
+            self.ax2.legend()
+
+        self.canvas.mpl_connect('draw_event', self.ondraw)
         self.update()
-        
+
+    def getContourPaths(self):
+        # { slice : { structure : (x, y) } }, where all (closed) contours of a structure are joined with NaN in between
+        contourPaths = dict()
+        for structure in self.activeStructures:
+            for zIdx, (cListX, cListY) in self.images.getStructureSlices(structure, simplified=False).items():
+                x = np.concatenate([np.append(np.append(k, k[0]), np.nan) for k in cListX])
+                y = np.concatenate([np.append(np.append(k, k[0]), np.nan) for k in cListY])
+                contourPaths.setdefault(zIdx, dict())[structure] = (x, y)
+
+        return contourPaths
+
+    def getSliceDVH(self, zIdx):
+        # { structure : (dose, volume) } of one slice, calculated on the first visit
+        if zIdx not in self.sliceDVH:
+            self.sliceDVH[zIdx] = dict()
+            image = self.X[zIdx, :, :]
+            dose = np.arange(0, self.options.maxDose, self.options.doseSegmentation.get())
+            for structure in self.activeStructures:
+                contours = self.images.getStructuresInImageCoordinates(structure, zIdx)
+                if not len(contours[0]):
+                    continue
+
+                linearContour = LinearContour(self.options)
+                for contourX, contourY in zip(*contours):
+                    linearContour.addLines(np.dstack((contourX, contourY))[0])
+                dvh = DVHAccumulator(dose, self.images.voxelVolume)
+                dvh.addSlice(image[linearContour.getListOfPixelsInContour(image)])
+                volume = dvh.getCumulativeVolume()
+
+                if self.options.volumeType.get() == 'absolute':
+                    volume *= cc # absolute dose in cc
+                elif volume[0] > 0:
+                    volume *= (100 /  volume[0]) # normalized dose in %
+                self.sliceDVH[zIdx][structure] = (dose, volume)
+
+        return self.sliceDVH[zIdx]
 
     def onscroll(self, event):
         if event.button == 'up':
@@ -676,51 +1069,37 @@ class IndexTracker(object):
             self.ind = (self.ind - 1) % self.slices
         self.update()
 
-    def update(self):
-        self.im.set_data(self.X[self.ind, :, :])
-        self.ax1.set_ylabel('slice %s' % self.ind)
-
-        self.ax1.lines = []
-        self.ax2.lines = []
+    def ondraw(self, event):
+        # After a full redraw, save the background without the animated artists and draw them on top
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self.drawArtists()
 
-        colors = ['r', 'g', 'b', 'y', 'c', 'm', 'orange', 'lightcoral',
-                  'peachpuff', 'olive', 'gold', 'navy', 'sienna', 'tan', 'crimson',
-                  'lime', 'goldenrod', 'moccasin', 'beige', 'tomato', 'mistyrose', 'darksalmon',
-                  'navajowhite', 'darkorange', 'snow', 'teal', 'deeppink', 'orchid']
-        
-        colStruct = dict(zip(self.images.listOfStructures, colors))
+    def drawArtists(self):
+        fig = self.canvas.figure
+        for artist in [self.im, self.sliceText] + list(self.contourLines.values()) + list(self.dvhLines.values()):
+            fig.draw_artist(artist)
 
-        activeStructures = [k for k,v in self.options.structureVariable.items() if v.get()]
-        activePlot = False
-        
-        for structure in activeStructures:            
-            contours = self.images.getStructuresInImageCoordinates(structure, self.ind)
-            lastVolume = None
-            
-            for contourX, contourY in zip(*contours):
-                self.ax1.plot(contourX, contourY, color=colStruct[structure])
-
-                linearContour = LinearContour(self.options)
-                linearContour.addLines(np.dstack((contourX, contourY))[0])
-                dose, volume = linearContour.getDVH(self.X[self.ind, :, :], self.images.voxelVolume, lastVolume)
-                lastVolume = volume
+    def update(self):
+        self.im.set_data(self.X[self.ind, ::self.step, ::self.step])
+        self.sliceText.set_text('slice %s' % self.ind)
+
+        contourPaths = self.contourPaths.get(self.ind, dict())
+        sliceDVH = self.getSliceDVH(self.ind)
+        for structure in self.activeStructures:
+            self.contourLines[structure].set_data(*contourPaths.get(structure, ([], [])))
+            self.dvhLines[structure].set_data(*sliceDVH.get(structure, ([], [])))
+
+        # A full redraw is only needed when the absolute volumes outgrow the axis
+        maxVolume = max([k[1][0] for k in sliceDVH.values()] + [0])
+        if self.background is None or maxVolume > self.ax2.get_ylim()[1]:
+            if maxVolume > self.ax2.get_ylim()[1]:
+                self.ax2.set_ylim(0, maxVolume * 1.05)
+            self.canvas.draw_idle()
+            return
 
-            if len(contours[0]):
-                if self.options.volumeType.get() == 'absolute':
-                    volume *= cc # absolute dose in cc
-                    self.ax2.set_ylabel("Volume [cc]")
-                else:
-                    volume *= (100 /  volume[0]) # normalized dose in %
-                    self.ax2.set_ylabel("Volume [%]")
-                    
-                self.ax2.plot(dose, volume, color=colStruct[structure], label=structure)
-                self.ax2.set_xlabel(f"Dose [{self.images.rd[0x3004,0x2].value.capitalize()}]")
-                activePlot = True
-                
-        if activePlot:
-            plt.legend()
-            
-        self.im.axes.figure.canvas.draw()
+        self.canvas.restore_region(self.background)
+        self.drawArtists()
+        self.canvas.blit(self.canvas.figure.bbox)
 
 class Line:
     def __init__(self, x0, y0, x1, y1):
@@ -768,103 +1147,1069 @@ class DVH:
 
     def calculateGEUD(self, n):
         # If more advanced dose metrics are needed, use DVH Tool v1.3 by Helge Pettersen
-        pass
+        return DVHMetrics(self.dose, [self.volume]).getGEUD([n])[0,0]
+
+class DVHMetrics:
+    # Dose metrics for many structures and evaluation points at once. volumes is a list of cumulative DVHs (the volume
+    # receiving more than each dose in dose, in mm^3, or in % for getGEUD and relative metrics only). The differential
+    # histogram is made once: bin i holds the volume with dose[i] < D <= dose[i+1], the last bin ends one bin width above.
+    def __init__(self, dose, volumes):
+        self.dose = np.asarray(dose, dtype=float)
+        self.volumes = np.array(volumes, dtype=float).reshape(len(volumes), len(self.dose))
+        self.totalVolume = self.volumes[:,0]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.relativeVolumes = self.volumes * 100 / self.totalVolume[:,np.newaxis]
+
+        binWidth = np.diff(self.dose)
+        binWidth = np.append(binWidth, len(binWidth) and binWidth[-1] or 1)
+        self.binEdges = np.append(self.dose, self.dose[-1] + binWidth[-1])
+        self.binCentres = self.dose + binWidth / 2
+
+        self.differentialVolumes = self.volumes.copy()
+        self.differentialVolumes[:,:-1] -= self.volumes[:,1:]
+
+    def getVolumeAtDose(self, atDoses):
+        # Relative volume [%] receiving atDoses, 0 when no volume is above it
+        atDoses = np.asarray(atDoses, dtype=float)
+        nBins = len(self.dose)
+        aboveIdx = np.searchsorted(self.dose, atDoses, side='right')
+        lowIdx = np.clip(aboveIdx - 1, 0, nBins-1)
+        highIdx = np.clip(aboveIdx, 0, nBins-1)
+        lowDose, highDose = self.dose[lowIdx], self.dose[highIdx]
+        fraction = np.where(highDose > lowDose, (atDoses - lowDose) / np.where(highDose > lowDose, highDose - lowDose, 1), 0)
+
+        lowVolume, highVolume = self.relativeVolumes[:,lowIdx], self.relativeVolumes[:,highIdx]
+        volume = lowVolume + fraction * (highVolume - lowVolume)
+        isEmpty = (aboveIdx >= nBins) | ~(highVolume > 0)
+
+        return np.where(isEmpty, 0, volume)
+
+    def getDoseAtVolume(self, atVolumes):
+        # Dose [Gy] received by the relative volumes atVolumes [%]
+        return np.array([np.interp(atVolumes, volume[::-1], self.dose[::-1]) for volume in self.relativeVolumes]).reshape(len(self.volumes), len(atVolumes))
+
+    def getDoseAtAbsoluteVolume(self, atVolumes):
+        # Dose [Gy] received by the absolute volumes atVolumes [cc]
+        atVolumes = np.asarray(atVolumes, dtype=float) / cc
+        return np.array([np.interp(atVolumes, volume[::-1], self.dose[::-1]) for volume in self.volumes]).reshape(len(self.volumes), len(atVolumes))
+
+    def getMeanDose(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.differentialVolumes @ self.binCentres / self.totalVolume
+
+    def getMinDose(self):
+        # Lower edge of the first non-empty bin
+        isFilled = self.differentialVolumes > 0
+        return np.where(isFilled.any(axis=1), self.binEdges[np.argmax(isFilled, axis=1)], 0)
+
+    def getMaxDose(self):
+        # Upper edge of the last non-empty bin
+        isFilled = self.differentialVolumes[:,::-1] > 0
+        return np.where(isFilled.any(axis=1), self.binEdges[len(self.dose) - np.argmax(isFilled, axis=1)], 0)
+
+    def getGEUD(self, nList):
+        # gEUD = (sum v_i D_i^(1/n))^n for each structure (rows) and n (columns), with v_i the volume fraction of bin i
+        nList = np.asarray(nList, dtype=float)
+        if not len(nList):
+            return np.zeros((len(self.volumes), 0))
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            volumeFraction = self.differentialVolumes / self.totalVolume[:,np.newaxis]
+            return (volumeFraction @ self.binCentres[:,np.newaxis] ** (1/nList)) ** nList
+
+    def getHomogeneityIndex(self):
+        # (D2% - D98%) / D50%
+        D2, D98, D50 = self.getDoseAtVolume([2, 98, 50]).T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (D2 - D98) / D50
+
+    def getConformityIndex(self, prescribedDose, externalIdx):
+        # Paddick conformity index TV_PIV^2 / (TV * PIV), the prescription isodose volume PIV from the external structure
+        volumeAtPrescription = np.array([np.interp(prescribedDose, self.dose, volume) for volume in self.volumes])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return volumeAtPrescription**2 / (self.totalVolume * volumeAtPrescription[externalIdx])
+
+class DVHAccumulator:
+    # Differential DVH as the number of dose samples per bin, each sample with the volume voxelVolume [mm3]. The bins are
+    # split at the doses in binEdges: bin 0 holds the samples up to binEdges[0], bin i those with binEdges[i-1] < D <=
+    # binEdges[i] and the last bin those above binEdges[-1]. Sample counts are integers, so partial DVHs of slices, slabs
+    # or other processes merge exactly, in any order. The get*Volume views are new arrays aligned with binEdges.
+    def __init__(self, binEdges, voxelVolume):
+        self.binEdges = np.asarray(binEdges, dtype=float)
+        self.voxelVolume = float(voxelVolume)
+        self.counts = np.zeros(len(self.binEdges) + 1, dtype=np.int64)
+
+    def addSlice(self, sampleDose):
+        # Adds the doses of the samples (e.g. the voxels of a structure in one slice)
+        binIdx = np.searchsorted(self.binEdges, np.ravel(sampleDose), side='left')
+        self.counts += np.bincount(binIdx, minlength=len(self.counts))
+
+    def merge(self, other):
+        # Adds the samples of another accumulator with the same bins and sample volume, returns self
+        if not np.array_equal(self.binEdges, other.binEdges) or self.voxelVolume != other.voxelVolume:
+            raise ValueError("Cannot merge DVHs with different dose bins or voxel volumes")
+
+        self.counts += other.counts
+        return self
+
+    def getTotalVolume(self):
+        # Volume [mm3] above the first dose bin, as the first value of the cumulative DVH
+        return self.counts[1:].sum() * self.voxelVolume
+
+    def getDifferentialVolume(self):
+        # Volume [mm3] with binEdges[i] < D <= binEdges[i+1]
+        return self.counts[1:] * self.voxelVolume
+
+    def getCumulativeVolume(self):
+        # Volume [mm3] receiving more than binEdges[i]
+        return np.cumsum(self.counts[::-1])[::-1][1:] * self.voxelVolume
+
+    def getAbsoluteVolume(self):
+        # Cumulative volume [cc]
+        return self.getCumulativeVolume() * cc
+
+    def getRelativeVolume(self):
+        # Cumulative volume [%] of the total volume, zero for an empty structure
+        volume = self.getCumulativeVolume()
+        if volume[0] > 0:
+            volume *= 100 / volume[0]
+
+        return volume
 
 class LinearContour:
     def __init__(self, options):
-        self.lines = list()
+        self.edges = np.zeros((0, 4))
         self.xmin = self.ymin = 1e5
         self.xmax = self.ymax = -1e5
         self.meshFactor = 1
         self.options = options
 
     def addLines(self, listOfPoints):
+        # Add one closed contour. Call once per contour to rasterize all contours of a structure on a slice together.
         # Remember to scale the structures as well as the dose mesh
-        listOfPoints = [[k[0]*self.meshFactor, k[1]*self.meshFactor] for k in listOfPoints]
-        
-        lastPoint = listOfPoints[-1]
-        self.xmin = self.xmax = lastPoint[0]
-        self.ymin = self.ymax = lastPoint[1]
-        
-        for point in listOfPoints:
-            self.xmin = min(self.xmin, point[0])
-            self.ymin = min(self.ymin, point[1])
-            self.xmax = max(self.xmax, point[0])
-            self.ymax = max(self.ymax, point[1])
-            
-            self.lines.append(Line(*lastPoint, *point))
-            lastPoint = point
+        points = np.asarray(listOfPoints, dtype=np.float64)[:,:2] * self.meshFactor
 
-    def getInterceptingLines(self, x=None, y=None):
-        interceptPoints = []
-        for line in self.lines:
-            intercept = line.findIntercept(x,y)
-            if intercept:
-                interceptPoints.append(intercept)
+        self.xmin = min(self.xmin, np.min(points[:,0]))
+        self.ymin = min(self.ymin, np.min(points[:,1]))
+        self.xmax = max(self.xmax, np.max(points[:,0]))
+        self.ymax = max(self.ymax, np.max(points[:,1]))
 
-        return interceptPoints   
+        # Each edge goes from the previous point to this one [x0, y0, x1, y1], closing the contour
+        edges = np.hstack((np.roll(points, 1, axis=0), points))
+        self.edges = np.vstack((self.edges, edges))
 
-    def findPixelInsideContourColumn(self, x, sh):
-        column = np.zeros(sh[0])
-        ray = self.getInterceptingLines(x, None)
+    def getInterceptingLines(self, columns):
+        # Returns the sorted y intercepts of all edges with each of the vertical lines x = columns (padded with inf),
+        # the index of the edge of each intercept and the number of intercepts per column
+        x = np.asarray(columns)[:,None]
+        x0, y0, x1, y1 = self.edges.T
 
-        yRangesInsideContour = []
-        for k in range(int((len(ray)+1)/2)):
-            yRangesInsideContour.append([int(ray[2*k]), int(ray[2*k+1]+1)])
-        
-        for yFrom, yTo in yRangesInsideContour:
-            ymin, ymax = sorted([yFrom, yTo])
-            column[ymin:ymax] = True
+        isIntercepting = ((x0 < x) & (x <= x1)) | ((x1 < x) & (x <= x0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intercepts = (x - x0) * (y1 - y0) / (x1 - x0) + y0
 
-        return column
-    
-    def getListOfPixelsInContour(self, image):
+        intercepts = np.where(isIntercepting, intercepts, np.inf)
+        edgeIdx = np.argsort(intercepts, axis=1, kind='stable')
+        interceptPoints = np.take_along_axis(intercepts, edgeIdx, axis=1)
+
+        return interceptPoints, edgeIdx, np.sum(isIntercepting, axis=1)
+
+    def getListOfPixelsInContour(self, image, pixelCentres = False):
+        # Even-odd fill rule over all contours at once: a pixel is inside between the 1st and 2nd, 3rd and 4th, ...
+        # intercept of its column. Inner contours (holes) are thereby subtracted, and the frame is only scanned once.
+        # With pixelCentres, only the pixels with their centre in a range are inside, for point sampling.
         sh = np.shape(image)
         contourMap = np.zeros(sh, dtype="bool")
 
-        for x in range(int(self.xmin), int(self.xmax+1)):
-            contourMap[:,x] = self.findPixelInsideContourColumn(x, sh)
+        columns = np.arange(max(int(self.xmin), 0), min(int(self.xmax), sh[1]-1) + 1)
+        if not len(columns) or not len(self.edges):
+            return contourMap
+
+        ray, edgeIdx, nIntercepts = self.getInterceptingLines(columns)
+        nRanges = nIntercepts // 2
+        maxRanges = np.max(nRanges)
+        if maxRanges == 0:
+            return contourMap
+
+        isRange = np.arange(maxRanges)[None,:] < nRanges[:,None]
+        yFrom = ray[:,0:2*maxRanges:2][isRange]
+        yTo = ray[:,1:2*maxRanges:2][isRange]
+        x = np.broadcast_to(columns[:,None], isRange.shape)[isRange]
+
+        if pixelCentres:
+            yFrom, yTo = np.ceil(yFrom), np.floor(yTo) + 1
+        else:
+            # The rows of the voxel DVHs, as they have always been: from int(y0) up to, not including, int(y1 + 1),
+            # where y0 is the intercept of the earlier edge of the contour and y1 that of the later one
+            isReversed = edgeIdx[:,0:2*maxRanges:2][isRange] > edgeIdx[:,1:2*maxRanges:2][isRange]
+            yFrom, yTo = np.trunc(yFrom + isReversed), np.trunc(yTo + 1 - isReversed)
+            yFrom, yTo = np.minimum(yFrom, yTo), np.maximum(yFrom, yTo)
+        yFrom = np.clip(yFrom, 0, sh[0]).astype(int)
+        yTo = np.clip(yTo, 0, sh[0]).astype(int)
+
+        rangeEdges = np.zeros((sh[0]+1, sh[1]), dtype=int)
+        np.add.at(rangeEdges, (yFrom, x), 1)
+        np.add.at(rangeEdges, (yTo, x), -1)
+        contourMap = np.cumsum(rangeEdges, axis=0)[:-1] > 0
 
         return contourMap
 
-    def getDVH(self, image, voxelVolume, lastVolume):
-        # Resize image to evaluate at more points
-        sh = np.shape(image)
-        sh = [sh[0]*self.meshFactor, sh[1]*self.meshFactor]
-        largerImage = np.zeros(sh)
-        for x in np.arange(sh[1]):
-            for y in np.arange(sh[0]):
-                largerImage[y,x] = image[y//self.meshFactor, x//self.meshFactor]
-
-        contourMap = self.getListOfPixelsInContour(largerImage)
-        contourImage = largerImage * contourMap
-        voxelVolume /= self.meshFactor**2
-
-        maxDose = self.options.maxDose
-        doseRange = np.arange(0, maxDose, self.options.doseSegmentation.get())
-        
-        if type(lastVolume) != type(None):
-            volumeRange = lastVolume
+def parseContourData(element):
+    # Parse a (3006,0050) ContourData element into an (N, 3) array of x, y, z points [mm].
+    # The raw DS string is split and converted in one go instead of through pydicom's DSfloat per coordinate.
+    value = element.value
+    if isinstance(value, bytes):
+        points = np.array(value.rstrip(b'\x00 ').split(b'\\'), dtype=np.float64)
+    else:
+        points = np.array(value, dtype=np.float64)
+
+    return np.reshape(points, (len(points)//3, 3))
+
+def simplifyContour(contour, tolerance):
+    # Douglas-Peucker simplification of a closed (N, 3) contour in the x/y plane: the points that are within tolerance
+    # [mm] of the simplified contour are left out. The contour is split at its first point and the point farthest from it.
+    nPoints = len(contour)
+    if tolerance <= 0 or nPoints < 4:
+        return contour
+
+    xy = np.vstack((contour[:,:2], contour[:1,:2])) # closed, index nPoints is the first point again
+    farthest = int(np.argmax(np.sum((xy[:nPoints] - xy[0])**2, axis=1)))
+    isKept = np.zeros(nPoints, dtype=bool)
+    isKept[[0, farthest]] = True
+
+    segments = [(0, farthest), (farthest, nPoints)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+
+        direction = xy[last] - xy[first]
+        points = xy[first+1:last] - xy[first]
+        length = np.hypot(direction[0], direction[1])
+        if length > 0:
+            distance = np.abs(direction[0] * points[:,1] - direction[1] * points[:,0]) / length
         else:
-            volumeRange = np.zeros(np.shape(doseRange))
-        
-        for idx, dose in enumerate(doseRange):
-            isAboveDose = contourImage > dose
-            absoluteVolume = voxelVolume * np.sum(contourMap[isAboveDose])
-            volumeRange[idx] += absoluteVolume
+            distance = np.hypot(points[:,0], points[:,1])
+
+        idx = int(np.argmax(distance))
+        if distance[idx] > tolerance:
+            isKept[first + 1 + idx] = True
+            segments += [(first, first + 1 + idx), (first + 1 + idx, last)]
+
+    if np.sum(isKept) < 3:
+        return contour
+
+    return contour[isKept]
+
+def getContourArea(contour):
+    # Area [mm2] enclosed by a closed contour in the x/y plane (shoelace formula)
+    x, y = contour[:,0], contour[:,1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+def isPointInContour(point, contour):
+    # Even-odd rule: a ray from the point in the +x direction crosses the contour an odd number of times
+    x0, y0 = contour[:,0], contour[:,1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    isCrossing = (y0 > point[1]) != (y1 > point[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossingX = x0 + (point[1] - y0) * (x1 - x0) / (y1 - y0)
+
+    return np.sum(isCrossing & (crossingX > point[0])) % 2 == 1
+
+def getContourPlaneArea(contours):
+    # Area [mm2] enclosed by the contours of one plane, with the even-odd rule of the rasterization: a contour inside
+    # an odd number of the other contours is a hole and its area is subtracted
+    area = 0
+    for idx, contour in enumerate(contours):
+        depth = sum([ isPointInContour(contour[0], other) for k, other in enumerate(contours) if k != idx ])
+        area += (depth % 2 and -1 or 1) * getContourArea(contour)
+
+    return area
+
+class Pipeline:
+    # Staged processing of a list of items: reader threads load the next items while the calling thread calculates the
+    # current one, and a writer thread writes the results. At most prefetchDepth loaded items wait for the calculation
+    # and writeDepth results for the writer. A reader also waits while the loaded items would take more than memoryLimit
+    # [bytes], as estimated by getSize(item), but a single item is always let through. With readerThreads = 0 the stages
+    # run one item at a time in the calling thread. If load(item), calculate(item, loaded) or write(item, result) raise,
+    # fail(item, error) is called instead of write. An exception from fail() itself is printed, so that no stage stops.
+    def __init__(self, load, calculate, write, fail, readerThreads = 2, prefetchDepth = 2, writeDepth = 4, memoryLimit = 0,
+                 getSize = None):
+        self.load = load
+        self.calculate = calculate
+        self.write = write
+        self.fail = fail
+        self.readerThreads = readerThreads
+        self.prefetchDepth = max(1, prefetchDepth)
+        self.writeDepth = max(1, writeDepth)
+        self.memoryLimit = memoryLimit
+        self.getSize = getSize
+        self.memoryInUse = 0
+        self.memoryCondition = threading.Condition()
+
+    def run(self, items):
+        # Returns the return values of write(), in the order the items were written
+        if not self.readerThreads:
+            results = list()
+            for item in items:
+                try:
+                    results.append(self.write(item, self.calculate(item, self.load(item))))
+                except Exception as e:
+                    self.reportFailure(item, e)
+            return results
+
+        self.itemQueue = queue.Queue()
+        for item in items:
+            self.itemQueue.put(item)
+        self.loadedQueue = queue.Queue(self.prefetchDepth)
+        self.writeQueue = queue.Queue(self.writeDepth)
+        self.results = list()
+
+        threads = [ threading.Thread(target=self.reader, daemon=True) for k in range(self.readerThreads) ]
+        writer = threading.Thread(target=self.writer, daemon=True)
+        for thread in threads + [writer]:
+            thread.start()
+
+        for k in range(len(items)):
+            item, loaded, error, size = self.loadedQueue.get()
+            result = None
+            if error is None:
+                try:
+                    result = self.calculate(item, loaded)
+                except Exception as e:
+                    error = e
+            del loaded
+            self.releaseMemory(size)
+            self.writeQueue.put((item, result, error))
+
+        self.writeQueue.put(None)
+        writer.join()
+        return self.results
+
+    def reserveMemory(self, size):
+        with self.memoryCondition:
+            while self.memoryLimit and self.memoryInUse > 0 and self.memoryInUse + size > self.memoryLimit:
+                self.memoryCondition.wait()
+            self.memoryInUse += size
+
+    def releaseMemory(self, size):
+        with self.memoryCondition:
+            self.memoryInUse -= size
+            self.memoryCondition.notify_all()
+
+    def reader(self):
+        while True:
+            try:
+                item = self.itemQueue.get_nowait()
+            except queue.Empty:
+                return
+
+            size = 0
+            try:
+                size = self.getSize and self.getSize(item) or 0
+                self.reserveMemory(size)
+                loaded, error = self.load(item), None
+            except Exception as e:
+                loaded, error = None, e
+            self.loadedQueue.put((item, loaded, error, size))
+
+    def writer(self):
+        while True:
+            job = self.writeQueue.get()
+            if job is None:
+                return
+
+            item, result, error = job
+            if error is None:
+                try:
+                    self.results.append(self.write(item, result))
+                    continue
+                except Exception as e:
+                    error = e
+            self.reportFailure(item, error)
+
+    def reportFailure(self, item, error):
+        try:
+            self.fail(item, error)
+        except Exception as e:
+            print(f"Could not report the failure of {item} ({error}): {e}")
+
+class JobManifest:
+    # JSON list of the RD/RS pairs of a batch run, with their status ('pending', 'running', 'done', 'failed'), input
+    # fingerprints and output files. Several worker processes, also on other machines through a shared folder, can use
+    # the same manifest: every read-modify-write is done while holding a lock file, and a pair is claimed before it is
+    # processed. Pairs are identified by the RD path relative to the data folder, so that workers with the data folder at
+    # different paths share them. Each worker fingerprints its own copy of the files, and the output files are stored
+    # relative to the manifest folder.
+    def __init__(self, filename, dataFolder, settings, staleTime = 3600):
+        self.filename = filename
+        self.folder = os.path.dirname(os.path.abspath(filename))
+        self.lockFilename = f"{filename}.lock"
+        self.dataFolder = os.path.isdir(dataFolder) and dataFolder or os.path.dirname(dataFolder)
+        self.settings = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+        self.staleTime = staleTime # [s] before a 'running' pair of a lost worker on another machine can be claimed again
+        self.worker = [socket.gethostname(), os.getpid()]
+
+        folder = os.path.dirname(filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def getJobId(self, rdFilename):
+        return os.path.relpath(rdFilename, self.dataFolder).replace("\\", "/")
+
+    def getFingerprint(self, rdFilename, rsFilename, beamFilenames = ()):
+        # beamFilenames: the other beam RD files summed with rdFilename. The modification times are rounded to whole
+        # seconds, as network file systems report them with different precision.
+        return [ [os.stat(k).st_size, int(os.stat(k).st_mtime)] for k in [rdFilename, rsFilename] + list(beamFilenames) ] + [self.settings]
+
+    def getOutputPath(self, filename):
+        # Output files are stored relative to the manifest folder
+        return os.path.relpath(os.path.abspath(filename), self.folder).replace("\\", "/")
+
+    def lock(self, timeout = 60):
+        # A lock file created exclusively. A lock older than timeout [s] is left by a crashed worker and is removed.
+        # It is first renamed to a name of our own, so that only one of the workers waiting for it removes it. If the
+        # renamed lock is not stale after all, another worker has taken the lock since the check, and it is put back
+        # (unless yet another worker has locked in the meantime).
+        staleFilename = f"{self.lockFilename}.{os.getpid()}_{threading.get_ident()}.stale"
+        while True:
+            try:
+                lockFile = os.open(self.lockFilename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(lockFile, json.dumps(self.worker).encode())
+                os.close(lockFile)
+                return
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lockFilename) > timeout:
+                        os.rename(self.lockFilename, staleFilename)
+                        try:
+                            if time.time() - os.path.getmtime(staleFilename) <= timeout:
+                                os.link(staleFilename, self.lockFilename)
+                        finally:
+                            os.remove(staleFilename)
+                except OSError:
+                    pass
+                time.sleep(0.05)
+
+    def unlock(self):
+        # The lock is missing if another worker has taken it as stale
+        try:
+            os.remove(self.lockFilename)
+        except FileNotFoundError:
+            pass
+
+    def update(self, function):
+        # Applies function to the jobs dictionary and writes the result, all while holding the lock
+        self.lock()
+        try:
+            jobs = dict()
+            if os.path.exists(self.filename):
+                with open(self.filename, "r") as manifestFile:
+                    jobs = json.load(manifestFile)
+
+            result = function(jobs)
+
+            with open(f"{self.filename}.tmp", "w") as manifestFile:
+                json.dump(jobs, manifestFile, indent=1)
+            os.replace(f"{self.filename}.tmp", self.filename)
+        finally:
+            self.unlock()
+
+        return result
+
+    def isFinished(self, job, fingerprint):
+        return job['status'] == 'done' and job['fingerprint'] == fingerprint and \
+               all([os.path.exists(os.path.join(self.folder, k)) for k in job['outputs']])
+
+    def isWorking(self, job):
+        # A pair that is being processed by another, live, worker
+        if job['status'] != 'running' or job['worker'] == self.worker:
+            return False
+
+        if job['worker'][0] == socket.gethostname():
+            return isProcessRunning(job['worker'][1])
+
+        return time.time() - job['updated'] < self.staleTime
+
+    def addJobs(self, pairs):
+        def addPairs(jobs):
+            for rdFilename, rsFilename, *beamFilenames in pairs:
+                jobId = self.getJobId(rdFilename)
+                fingerprint = self.getFingerprint(rdFilename, rsFilename, beamFilenames)
+                if jobId in jobs and (self.isFinished(jobs[jobId], fingerprint) or self.isWorking(jobs[jobId])):
+                    continue
+
+                jobs[jobId] = { 'rd' : rdFilename, 'rs' : rsFilename, 'beams' : beamFilenames, 'status' : 'pending',
+                                'fingerprint' : fingerprint, 'outputs' : list(), 'worker' : None, 'updated' : time.time(),
+                                'message' : "" }
+
+        self.update(addPairs)
+
+    def claim(self, rdFilename, rsFilename, beamFilenames = ()):
+        # Returns True if this worker should process the pair, i.e. it is not finished or being processed elsewhere.
+        # The fingerprint is made from this worker's files, the paths in the manifest can be those of another worker.
+        fingerprint = self.getFingerprint(rdFilename, rsFilename, beamFilenames)
+        def claimPair(jobs):
+            job = jobs.get(self.getJobId(rdFilename))
+            if not job or self.isFinished(job, fingerprint) or self.isWorking(job):
+                return False
+
+            job.update({ 'status' : 'running', 'worker' : self.worker, 'updated' : time.time() })
+            return True
+
+        return self.update(claimPair)
+
+    def setStatus(self, rdFilename, status, outputs = None, message = ""):
+        def setPairStatus(jobs):
+            job = jobs[self.getJobId(rdFilename)]
+            job.update({ 'status' : status, 'outputs' : [self.getOutputPath(k) for k in outputs or list()],
+                         'updated' : time.time(), 'message' : message })
+
+        self.update(setPairStatus)
+
+    def complete(self, rdFilename, outputs):
+        self.setStatus(rdFilename, 'done', outputs)
+
+    def fail(self, rdFilename, message):
+        self.setStatus(rdFilename, 'failed', message=message)
+
+def isProcessRunning(pid):
+    if os.name == 'nt':
+        import ctypes
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        exitCode = ctypes.c_ulong()
+        ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exitCode))
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return exitCode.value == 259 # STILL_ACTIVE
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
 
-        return doseRange, volumeRange
+class DoseGrid:
+    # RD dose grid read on demand through a memory map of the (uncompressed) pixel data in the file, for dose grids
+    # that do not fit in memory. Indexing returns the scaled dose of the requested frames only, as pixel_array * scaling.
+    def __init__(self, filename):
+        self.rd = pydicom.dcmread(filename, defer_size="1 KB")
+        self.scaling = self.rd[0x3004,0xE].value
+        self.shape = (int(self.rd.NumberOfFrames), int(self.rd.Rows), int(self.rd.Columns))
+
+        transferSyntax = self.rd.file_meta.TransferSyntaxUID
+        if transferSyntax.is_compressed or not transferSyntax.is_little_endian:
+            print(f"Compressed pixel data in {filename}, the whole dose grid is decoded.")
+            self.pixels = np.reshape(self.rd.pixel_array, self.shape)
+        else:
+            pixelData = self.rd.get_item(0x7FE00010, keep_deferred=True)
+            dtype = f"<{self.rd.PixelRepresentation and 'i' or 'u'}{self.rd.BitsAllocated//8}"
+            self.pixels = np.memmap(filename, dtype=dtype, mode='r', offset=pixelData.value_tell, shape=self.shape)
+
+    def __getitem__(self, idx):
+        return self.pixels[idx] * self.scaling
+
+    def __len__(self):
+        return self.shape[0]
+
+    def max(self):
+        return max([np.max(self.pixels[z]) for z in range(self.shape[0])]) * self.scaling
+
+    def writeNpy(self, filename):
+        # Writes the scaled dose grid to a .npy file, one frame at a time
+        out = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64, shape=self.shape)
+        for z in range(self.shape[0]):
+            out[z] = self[z]
+        out.flush()
+        del out
+
+class DoseSum:
+    # Plan dose grid as the sum of beam dose grids (DoseGrids or memory-mapped cached grids), evaluated on demand:
+    # indexing returns the sum of the requested frames of each beam, so the plan dose is never in memory as a whole.
+    def __init__(self, beamDoses):
+        self.beamDoses = beamDoses
+        self.shape = tuple(np.shape(beamDoses[0]))
+
+    def __getitem__(self, idx):
+        dose = np.array(self.beamDoses[0][idx], dtype=np.float64)
+        for beamDose in self.beamDoses[1:]:
+            dose += beamDose[idx]
+        return dose
+
+    def __len__(self):
+        return self.shape[0]
+
+    def max(self):
+        return max([np.max(self[z]) for z in range(self.shape[0])])
+
+class DicomCache:
+    # Local cache of decoded RD dose grids and parsed RS contours, so that unchanged files are not decoded by pydicom again.
+    # An entry is keyed by the SOPInstanceUID, modification time and size of the file, and consists of the DICOM header
+    # (as DICOM JSON, without pixel / contour data) and .npy arrays, which are memory-mapped when read.
+    # The least recently used entries are removed when the cache is larger than maxSize [bytes].
+    def __init__(self, folder = "cache", maxSize = 2e9):
+        self.folder = folder
+        self.maxSize = maxSize
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def getKey(self, filename):
+        stat = os.stat(filename)
+        try:
+            uid = pydicom.filereader.read_file_meta_info(filename).MediaStorageSOPInstanceUID
+        except Exception: # no file meta information, use the file content instead
+            with open(filename, "rb") as dicomFile:
+                uid = hashlib.sha1(dicomFile.read()).hexdigest()
+
+        return hashlib.sha1(f"{uid}_{stat.st_mtime_ns}_{stat.st_size}".encode()).hexdigest()
+
+    def getPath(self, key, suffix):
+        return os.path.join(self.folder, f"{key}.{suffix}")
+
+    def getTemporaryPath(self, key, suffix):
+        # Unique per process and thread, so that writers of the same entry do not write into each other's file
+        return self.getPath(key, f"{suffix}.{os.getpid()}_{threading.get_ident()}.tmp")
+
+    def readEntry(self, key, arrayNames):
+        # Returns the header dataset, the entry info and the memory-mapped arrays, or None if not cached
+        headerPath = self.getPath(key, "json")
+        if not os.path.exists(headerPath) or not all([os.path.exists(self.getPath(key, k)) for k in arrayNames]):
+            return None
+
+        try:
+            os.utime(headerPath) # last access time, used for the eviction
+            with open(headerPath, "r") as headerFile:
+                entry = json.load(headerFile)
+
+            arrays = [ np.load(self.getPath(key, k), mmap_mode='r') for k in arrayNames ]
+        except (OSError, ValueError) as e: # evicted meanwhile by another process, or not a complete file
+            print(f"Could not read cache entry {key}, reading the DICOM file instead: {e}")
+            return None
+
+        return pydicom.Dataset.from_json(entry['header']), entry['info'], arrays
+
+    def writeEntry(self, key, header, info, arrays):
+        # The arrays are written first and the header last, so that only complete entries are read.
+        # Each file is written under a temporary name and then renamed, for concurrent threads and processes sharing the
+        # cache. The last writer of an entry wins, readers only see complete files.
+        try:
+            entry = json.dumps({ 'header' : header.to_json_dict(), 'info' : info })
+        except Exception as e:
+            print(f"Could not cache {key}: {e}")
+            return
+
+        for suffix, array in arrays.items():
+            temporaryPath = self.getTemporaryPath(key, suffix)
+            if isinstance(array, DoseGrid):
+                array.writeNpy(temporaryPath)
+            else:
+                with open(temporaryPath, "wb") as arrayFile:
+                    np.save(arrayFile, array)
+            os.replace(temporaryPath, self.getPath(key, suffix))
+
+        temporaryPath = self.getTemporaryPath(key, "json")
+        with open(temporaryPath, "w") as headerFile:
+            headerFile.write(entry)
+        os.replace(temporaryPath, self.getPath(key, "json"))
+
+        self.evict(key)
+
+    def evict(self, keepKey = None, writeTimeout = 600):
+        # Other threads and processes write and remove entries meanwhile: files can disappear between listing and stat
+        # or remove. An entry with a *.tmp file or without its header is still being written and is not removed, unless
+        # it is older than writeTimeout [s] (left by a crashed writer).
+        entries, tmpKeys, headerKeys = dict(), set(), set()
+        for filename in os.listdir(self.folder):
+            key = filename.split(".")[0]
+            path = os.path.join(self.folder, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            size, lastAccess = entries.get(key, [0, 0])
+            entries[key] = [size + stat.st_size, max(lastAccess, stat.st_mtime)]
+            if filename.endswith(".tmp"):
+                tmpKeys.add(key)
+            elif filename.endswith(".json"):
+                headerKeys.add(key)
+
+        totalSize = sum([k[0] for k in entries.values()])
+        for key, (size, lastAccess) in sorted(entries.items(), key=lambda k: k[1][1]):
+            if totalSize <= self.maxSize:
+                break
+            if key == keepKey:
+                continue
+            if (key in tmpKeys or key not in headerKeys) and time.time() - lastAccess < writeTimeout:
+                continue
+
+            for filename in os.listdir(self.folder):
+                if filename.split(".")[0] == key:
+                    try:
+                        os.remove(os.path.join(self.folder, filename))
+                    except FileNotFoundError:
+                        pass
+            totalSize -= size
+
+    def readDose(self, filename, streaming = False):
+        # Returns the RD header and the scaled dose grid. When streaming, a new entry is written frame by frame.
+        key = self.getKey(filename)
+        cached = self.readEntry(key, ["dose.npy"])
+        if cached:
+            return cached[0], cached[2][0]
+
+        if streaming:
+            doseGrid = DoseGrid(filename)
+            rd = doseGrid.rd
+            del rd.PixelData
+
+            self.writeEntry(key, rd, dict(), { "dose.npy" : doseGrid })
+            cached = self.readEntry(key, ["dose.npy"])
+            if cached:
+                return rd, cached[2][0]
+            return rd, doseGrid
+
+        rd = pydicom.dcmread(filename)
+        doseImage = rd.pixel_array * rd[0x3004,0xE].value
+        del rd.PixelData
+
+        self.writeEntry(key, rd, dict(), { "dose.npy" : doseImage })
+        return rd, doseImage
+
+    def readStructures(self, filename):
+        # Returns the RS header (ROIContourSequence without the ContourSequence) and
+        # { ROI number : list of (N, 3) contour arrays }
+        key = self.getKey(filename)
+        cached = self.readEntry(key, ["points.npy"])
+        if cached:
+            rs, info, (points,) = cached
+            offsets = np.cumsum([0] + [k[1] for k in info['contours']])
+            contours = dict()
+            for (roiNumber, length), offset in zip(info['contours'], offsets):
+                contours.setdefault(roiNumber, list()).append(points[offset:offset+length])
+            return rs, contours
+
+        rs = pydicom.dcmread(filename)
+        contours = dict()
+        for seq in rs.ROIContourSequence:
+            if 'ContourSequence' in seq:
+                contours[seq.ReferencedROINumber] = [ parseContourData(cont.get_item(0x30060050)) for cont in seq.ContourSequence ]
+                del seq.ContourSequence
+
+        contourList = [ [int(roiNumber), c] for roiNumber, cList in contours.items() for c in cList ]
+        info = { 'contours' : [ [roiNumber, len(c)] for roiNumber, c in contourList ] }
+        points = np.vstack([c for roiNumber, c in contourList] + [np.zeros((0, 3))])
+
+        self.writeEntry(key, rs, info, { "points.npy" : points })
+        return rs, contours
+
+class StructureFilter:
+    # Selects the structures to load from an RS file by name (fnmatch patterns, case insensitive) and by
+    # RT ROI Interpreted Type. Empty pattern / type lists select everything.
+    def __init__(self, include = "", exclude = "", roiTypes = ""):
+        self.include = include.lower().split()
+        self.exclude = exclude.lower().split()
+        self.roiTypes = roiTypes.upper().split()
+
+    def getROITypes(self, rs):
+        # { ROI number : RT ROI Interpreted Type }
+        roiTypes = dict()
+        for seq in rs.get('RTROIObservationsSequence', []):
+            roiTypes[seq.ReferencedROINumber] = seq.get('RTROIInterpretedType', '')
+
+        return roiTypes
+
+    def getStructures(self, rs):
+        # { ROI number : name } of the selected structures in an RS file
+        roiTypes = self.getROITypes(rs)
+        structureDict = dict()
+        for seq in rs.StructureSetROISequence:
+            if self.isSelected(seq[0x3006, 0x26].value, roiTypes.get(seq[0x3006, 0x22].value)):
+                structureDict[seq[0x3006, 0x22].value] = seq[0x3006, 0x26].value
+
+        return structureDict
+
+    def isSelected(self, structureName, roiType):
+        structureName = structureName.lower()
+        if self.include and not any(fnmatch.fnmatchcase(structureName, k) for k in self.include):
+            return False
+        if any(fnmatch.fnmatchcase(structureName, k) for k in self.exclude):
+            return False
+        if self.roiTypes and (roiType or '').upper() not in self.roiTypes:
+            return False
+
+        return True
+
+def getSlabSize(shape, memoryLimit):
+    # Number of dose slices read at a time with a memoryLimit [MB], all of them without. Half of the memory limit
+    # is used for the slab, the rest for the per-slice calculations.
+    return memoryLimit and min(shape[0], max(1, int(memoryLimit * 2**20 / (2 * 8 * shape[1] * shape[2])))) or shape[0]
+
+def getBeamNumber(rd):
+    # Referenced beam number of a beam dose (DoseSummationType BEAM), None if not given
+    try:
+        return int(rd.ReferencedRTPlanSequence[0].ReferencedFractionGroupSequence[0].ReferencedBeamSequence[0].ReferencedBeamNumber)
+    except (AttributeError, IndexError):
+        return None
+
+def isSameDoseGrid(rd, otherRd):
+    # True if the two RD files have the same dose grid geometry
+    for tag in ['Rows', 'Columns', 'NumberOfFrames', 'PixelSpacing', 'ImagePositionPatient', 'ImageOrientationPatient',
+                'GridFrameOffsetVector']:
+        value, otherValue = np.array(rd.get(tag, []), dtype=float), np.array(otherRd.get(tag, []), dtype=float)
+        if np.shape(value) != np.shape(otherValue) or not np.allclose(value, otherValue, atol=1e-3):
+            return False
+
+    return True
+
+def groupDoseFiles(rdFilenames):
+    # Groups RD files by the plan they reference. Returns a list of single RD files (plan doses) and lists of the beam
+    # RD files (DoseSummationType BEAM) of a plan to be summed. Beam doses are left out when the plan dose is also given.
+    plans = dict()
+    for filename in rdFilenames:
+        rd = pydicom.dcmread(filename, stop_before_pixels=True)
+        planUID = filename
+        if len(rd.get('ReferencedRTPlanSequence', [])):
+            planUID = rd.ReferencedRTPlanSequence[0].ReferencedSOPInstanceUID
+        plans.setdefault(planUID, list()).append([filename, rd])
+
+    groups = list()
+    for planUID, doses in plans.items():
+        planDoses = [ filename for filename, rd in doses if rd.get('DoseSummationType', '') != 'BEAM' ]
+        beamDoses = sorted([ [getBeamNumber(rd), filename, rd] for filename, rd in doses if rd.get('DoseSummationType', '') == 'BEAM' ],
+                           key=lambda beam: [beam[0] is None, beam[0] or 0, beam[1]])
+        if planDoses or len(beamDoses) == 1:
+            groups += planDoses or [beamDoses[0][1]]
+        elif not all(isSameDoseGrid(beamDoses[0][2], rd) for number, filename, rd in beamDoses):
+            print(f"The beam doses of plan {planUID} are not on the same dose grid and cannot be summed, skipping them.")
+        else:
+            groups.append([ filename for number, filename, rd in beamDoses ])
+
+    return groups
+
+def setOutputNames(handles):
+    # The output files are named after the patient. When several pairs have the same patient (e.g. two plan doses with
+    # one RS file), the RD file name is added, and the position of the pair if that is not unique either.
+    for handle in handles:
+        handle.outputName = f"{handle.rs.PatientName}"
+
+    names = [ handle.outputName for handle in handles ]
+    for handle in handles:
+        if names.count(handle.outputName) > 1:
+            handle.outputName += f"_{os.path.splitext(os.path.basename(handle.rdFilename))[0]}"
+
+    names = [ handle.outputName for handle in handles ]
+    for idx, handle in enumerate(handles):
+        if names.count(handle.outputName) > 1:
+            handle.outputName += f"_{idx+1}"
+
+class SeriesHandle:
+    # An RD/RS pair as the file names and the DICOM headers only (no dose grid or contours), load() reads the full Series.
+    # rd is an RD file, or a list of beam RD files that are summed when loaded.
+    RSHeaderTags = ['PatientName', 'PatientID', 'ApprovalStatus', 'StructureSetROISequence', 'RTROIObservationsSequence']
+
+    def __init__(self, rd, rs, cache = None, memoryLimit = 0, structureFilter = None, contourTolerance = 0):
+        self.beamFilenames = list()
+        if isinstance(rd, (list, tuple)):
+            self.beamFilenames = list(rd)
+            rd = rd[0]
+
+        self.rdFilename = rd
+        self.rsFilename = rs
+        self.cache = cache
+        self.memoryLimit = memoryLimit
+        self.structureFilter = structureFilter
+        self.contourTolerance = contourTolerance
+
+        self.rd = pydicom.dcmread(rd, stop_before_pixels=True)
+        self.rs = pydicom.dcmread(rs, specific_tags=self.RSHeaderTags)
+        self.listOfStructures = list((structureFilter or StructureFilter()).getStructures(self.rs).values())
+        self.outputName = f"{self.rs.PatientName}" # prefix of the output files, see setOutputNames()
+
+    def getMemorySize(self):
+        # Estimated memory [bytes] for the DVH calculation: the scaled dose of one slab of slices, or the plan dose
+        # and one beam dose (a slab of the sum and of one beam with a memory limit) when summing beam doses
+        shape = (int(self.rd.NumberOfFrames), int(self.rd.Rows), int(self.rd.Columns))
+        slabSize = getSlabSize(shape, self.memoryLimit)
+        if self.beamFilenames:
+            return 2 * slabSize * shape[1] * shape[2] * 8
+
+        return slabSize * shape[1] * shape[2] * 8
+
+    def load(self, beamDVHStructures = (), doseSegmentation = 0.1, options = None):
+        series = Series(rd=self.beamFilenames or self.rdFilename, rs=self.rsFilename, cache=self.cache, memoryLimit=self.memoryLimit)
+        series.loadStructures(None, self.structureFilter, self.contourTolerance)
+        series.outputName = self.outputName
+        if series.beamFilenames:
+            series.sumBeamDoses(beamDVHStructures, doseSegmentation, options)
+        return series
+
+class SeriesPool:
+    # Keeps the Series of the size most recently used SeriesHandles in memory, the others are read again when needed
+    def __init__(self, size = 1):
+        self.size = size
+        self.series = dict() # SeriesHandle : Series, least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, handle, beamDVHStructures = (), doseSegmentation = 0.1, options = None):
+        # A kept Series is read again if it lacks the requested per-beam DVHs
+        with self.lock:
+            if handle in self.series and (not handle.beamFilenames or not beamDVHStructures or
+                                          self.series[handle].beamDVHSettings == [list(beamDVHStructures), doseSegmentation]):
+                self.series[handle] = self.series.pop(handle)
+                return self.series[handle]
+
+        series = handle.load(beamDVHStructures, doseSegmentation, options)
+        with self.lock:
+            if self.size > 0:
+                self.series[handle] = series
+                while len(self.series) > self.size:
+                    del self.series[next(iter(self.series))]
+
+        return series
 
 class Series:
-    def __init__(self, rd = None, rs = None, progress=None):
-        self.rs = pydicom.dcmread(rs)
-        self.rd = pydicom.dcmread(rd)
+    def __init__(self, rd = None, rs = None, progress=None, cache=None, memoryLimit=0):
+        # With a memoryLimit [MB], the dose grid is not decoded into memory but read in slabs of slices (getDoseSlabs).
+        # rd can be a list of beam RD files of one plan, the dose grid is then made by sumBeamDoses().
+        self.beamFilenames = list()
+        self.beamDVH = dict() # { beam number : (dose bins, { structure : DVHAccumulator }) }
+        self.beamDVHSettings = None
+        if isinstance(rd, (list, tuple)):
+            self.beamFilenames = list(rd)
+            rd = rd[0]
+
+        self.rdFilename = rd
+        self.rsFilename = rs
+        self.cache = cache
+        self.memoryLimit = memoryLimit
+        self.cachedContours = None
+        if self.beamFilenames:
+            if cache:
+                self.rs, self.cachedContours = cache.readStructures(rs)
+            else:
+                self.rs = pydicom.dcmread(rs)
+            self.rd = pydicom.dcmread(rd, stop_before_pixels=True)
+            self.doseImage = None
+        elif cache:
+            self.rs, self.cachedContours = cache.readStructures(rs)
+            self.rd, self.doseImage = cache.readDose(rd, streaming=memoryLimit > 0)
+        elif memoryLimit:
+            self.rs = pydicom.dcmread(rs)
+            self.doseImage = DoseGrid(rd)
+            self.rd = self.doseImage.rd
+        else:
+            self.rs = pydicom.dcmread(rs)
+            self.rd = pydicom.dcmread(rd)
+            self.doseImage = self.rd.pixel_array * self.rd[0x3004,0xE].value
+
+        self.outputName = f"{self.rs.PatientName}" # prefix of the output files
         stlist = self.rd[self.rd.FrameIncrementPointer].value
         self.sliceThickness = float(stlist[1]) - float(stlist[0])
         self.voxelVolume = self.sliceThickness * self.rd.PixelSpacing[0] * self.rd.PixelSpacing[1]
-        self.doseImage = self.rd.pixel_array * self.rd[0x3004,0xE].value
-        self.maxDose = round(np.max(self.doseImage)*1.05+5,-1)
+        self.maxDose = None
+        if self.doseImage is not None:
+            self.maxDose = round(self.doseImage.max()*1.05+5,-1)
+
+        self.shape = (int(self.rd.NumberOfFrames), int(self.rd.Rows), int(self.rd.Columns))
+        self.slabSize = getSlabSize(self.shape, memoryLimit)
         self.contours = dict()
+        self.contourData = dict()
+        self.structureSlices = dict()
+        self.contourTolerance = 0
+        self.simplifiedContours = dict()
+
+    def sumBeamDoses(self, beamDVHStructures = (), doseSegmentation = 0.1, options = None):
+        # Makes the plan dose grid as the sum of the beam doses, reading one beam RD file at a time, so that only one
+        # beam dose grid and the sum are in memory. With a memory limit, the beam dose grids are read on demand instead
+        # and summed slab by slab (DoseSum). The DVHs of beamDVHStructures are made from each beam dose while it is
+        # read, in self.beamDVH. Needs loadStructures() first for the beam DVHs.
+        planDose = None
+        if not self.memoryLimit:
+            planDose = np.zeros(self.shape)
+        beamDoses = list()
+        self.beamDVH = dict()
+        for fileIdx, filename in enumerate(self.beamFilenames):
+            if self.cache:
+                rd, beamDose = self.cache.readDose(filename, streaming=self.memoryLimit > 0)
+            elif self.memoryLimit:
+                beamDose = DoseGrid(filename)
+                rd = beamDose.rd
+            else:
+                rd = pydicom.dcmread(filename)
+                beamDose = rd.pixel_array * rd[0x3004,0xE].value
+            if not isSameDoseGrid(self.rd, rd):
+                raise ValueError(f"{filename} is not on the same dose grid as {self.beamFilenames[0]}")
+
+            if isinstance(beamDose, np.ndarray):
+                beamDose = np.reshape(beamDose, self.shape)
+            if planDose is None:
+                beamDoses.append(beamDose)
+            else:
+                planDose += beamDose
+
+            if len(beamDVHStructures):
+                # Beams without a (unique) beam number are named after their position in the group: _beamfile<n>
+                beamNumber = getBeamNumber(rd)
+                if beamNumber is None or beamNumber in self.beamDVH:
+                    print(f"{filename} has a missing or duplicate beam number ({beamNumber}), saving its DVHs as beam file{fileIdx+1}.")
+                    beamNumber = f"file{fileIdx+1}"
+                dose = np.arange(0, round(beamDose.max()*1.05+5,-1), doseSegmentation)
+                beamSlabs = ( (z0, beamDose[z0:z0+self.slabSize]) for z0 in range(0, self.shape[0], self.slabSize) )
+                self.beamDVH[beamNumber] = (dose, self.getStructureDVHs(beamDVHStructures, dose, options, beamSlabs))
+            del rd, beamDose
+
+        self.doseImage = planDose
+        if planDose is None:
+            self.doseImage = DoseSum(beamDoses)
+        self.maxDose = round(self.doseImage.max()*1.05+5,-1)
+        self.beamDVHSettings = [list(beamDVHStructures), doseSegmentation]
+
+    def getStructureDVHs(self, structureNames, doseRange, options, doseSlabs = None, progress = None):
+        # { structure : DVHAccumulator } of the voxel doses inside each structure, over the (first slice index, dose slab)
+        # pairs in doseSlabs, by default the whole dose grid from getDoseSlabs()
+        if doseSlabs is None:
+            doseSlabs = self.getDoseSlabs()
+
+        structureDVH = { s : DVHAccumulator(doseRange, self.voxelVolume) for s in structureNames }
+        for z0, slab in doseSlabs:
+            for z in range(z0, z0 + len(slab)):
+                for structure in structureNames:
+                    if progress:
+                        progress.step(1)
+                        progress.update_idletasks()
+
+                    contours = self.getStructuresInImageCoordinates(structure, z)
+                    if not len(contours[0]):
+                        continue
+
+                    linearContour = LinearContour(options)
+                    for contourX, contourY in zip(*contours):
+                        linearContour.addLines(np.dstack((contourX, contourY))[0])
+                    structureDVH[structure].addSlice(slab[z-z0][linearContour.getListOfPixelsInContour(slab[z-z0])])
+
+        return structureDVH
+
+    def prefetch(self, structureNames):
+        # Reads what the DVH calculation of structureNames needs ahead of time, e.g. in a reader thread: the contours
+        # are parsed, and a memory-mapped dose grid is read once so that its pages are in memory
+        for structureName in structureNames:
+            self.getStructureSlices(structureName)
+
+        doseGrids = [self.doseImage]
+        if isinstance(self.doseImage, DoseSum):
+            doseGrids = self.doseImage.beamDoses
+        for pixels in doseGrids:
+            if isinstance(pixels, DoseGrid):
+                pixels = pixels.pixels
+            if isinstance(pixels, np.memmap):
+                for z in range(len(pixels)):
+                    np.max(pixels[z])
 
     def loadRBE(self, progress = None):
         pass
@@ -875,38 +2220,225 @@ class Series:
     def recalculateDose(self, progress = None):
         pass
 
-    def loadStructures(self, progress = None):
-        structureDict = dict()
-        for seq in self.rs.StructureSetROISequence:
-            structureDict[seq[0x3006, 0x22].value] = seq[0x3006, 0x26].value
+    def loadStructures(self, progress = None, structureFilter = None, contourTolerance = 0):
+        # Only the structures selected by structureFilter are loaded, the contours of the others are dropped unread.
+        # With a contourTolerance [fraction of the dose pixel size], the contours are simplified before rasterization.
+        structureDict = (structureFilter or StructureFilter()).getStructures(self.rs)
+        self.contourTolerance = contourTolerance
+        self.simplifiedContours = dict()
 
         self.listOfStructures = structureDict.values()
 
+        self.contours = dict()
+        self.structureSlices = dict()
         for structureName in structureDict.values():
-            self.contours[structureName] = list()
+            self.contourData[structureName] = list()
+
+        if self.cachedContours is not None: # already parsed
+            for structureName in structureDict.values():
+                self.contours[structureName] = list()
+            for roiNumber, contours in self.cachedContours.items():
+                if int(roiNumber) in structureDict:
+                    self.contours[structureDict[int(roiNumber)]] += contours
+            if progress:
+                progress.step(len(self.rs.ROIContourSequence))
+                progress.update_idletasks()
+            return
 
         for idx, seq in enumerate(self.rs.ROIContourSequence): # Loop over the different structures
             if progress:
                 progress.step(1)
                 progress.update_idletasks()
             
+            if seq.ReferencedROINumber not in structureDict:
+                if 'ContourSequence' in seq:
+                    del seq.ContourSequence
+                continue
+
             thisStructure = structureDict[seq.ReferencedROINumber]
             
             if 'ContourSequence' in seq:
                 for cont in seq.ContourSequence: # Loop over slices
-                    cd = cont.ContourData
-                    self.contours[thisStructure].append(np.reshape(cd, (len(cd)//3, 3)))
+                    # Keep the undecoded (3006,0050) ContourData element, it is parsed in getContours()
+                    self.contourData[thisStructure].append(cont.get_item(0x30060050))
+
+    def getContours(self, structureName):
+        # Convert the ContourData of a structure the first time it is requested
+        if structureName not in self.contours:
+            self.contours[structureName] = [ parseContourData(cd) for cd in self.contourData[structureName] ]
+
+        return self.contours[structureName]
+
+    def getSimplifiedContours(self, structureName):
+        # The contours of a structure as they are rasterized: simplified with contourTolerance, calculated once per
+        # structure. The change of the contour volume (from the contour areas of each plane, holes subtracted) is printed
+        # to verify the tolerance.
+        if not self.contourTolerance:
+            return self.getContours(structureName)
+
+        if structureName not in self.simplifiedContours:
+            tolerance = self.contourTolerance * min(float(self.rd.PixelSpacing[0]), float(self.rd.PixelSpacing[1]))
+            contours = self.getContours(structureName)
+            simplifiedContours = [ simplifyContour(contour, tolerance) for contour in contours ]
+
+            contourPlanes = dict()
+            for idx, contour in enumerate(contours):
+                contourPlanes.setdefault(round(contour[0,2], 2), list()).append(idx)
+
+            area, areaDeviation = 0, 0
+            for plane in contourPlanes.values():
+                planeArea = getContourPlaneArea([ contours[k] for k in plane ])
+                area += planeArea
+                areaDeviation += getContourPlaneArea([ simplifiedContours[k] for k in plane ]) - planeArea
+            nPoints, nSimplifiedPoints = sum([len(k) for k in contours]), sum([len(k) for k in simplifiedContours])
+            deviation = area > 0 and 100 * areaDeviation / area or 0
+            print(f"Simplified {structureName}: {nPoints} -> {nSimplifiedPoints} contour points, contour volume "
+                  f"change {areaDeviation * self.sliceThickness * cc:+.3f} cc ({deviation:+.3f}%).")
+
+            self.simplifiedContours[structureName] = simplifiedContours
+
+        return self.simplifiedContours[structureName]
+
+    def getContourPlanes(self, structureName):
+        # Returns the contours of a structure grouped by their z position [mm]
+        contourPlanes = dict()
+        for contour in self.getSimplifiedContours(structureName):
+            contourPlanes.setdefault(round(contour[0,2], 2), list()).append(contour)
+
+        return contourPlanes
+
+    def interpolateDose(self, zIdx, yIdx, xIdx):
+        # Trilinear interpolation of the dose grid at (fractional) voxel indices, clamped to the grid
+        img = self.doseImage
+        lower, upper, weight = list(), list(), list()
+        for idx, n in zip([zIdx, yIdx, xIdx], np.shape(img)):
+            idx = np.clip(idx, 0, n-1)
+            idx0 = np.minimum(np.floor(idx).astype(int), max(n-2, 0))
+            lower.append(idx0)
+            upper.append(np.minimum(idx0+1, n-1))
+            weight.append(idx - idx0)
+
+        dose = 0
+        for cornerZ, wz in [[lower[0], 1-weight[0]], [upper[0], weight[0]]]:
+            for cornerY, wy in [[lower[1], 1-weight[1]], [upper[1], weight[1]]]:
+                for cornerX, wx in [[lower[2], 1-weight[2]], [upper[2], weight[2]]]:
+                    dose = dose + wz * wy * wx * img[cornerZ, cornerY, cornerX]
+
+        return dose
+
+    def getInterpolatedDVH(self, structureName, doseRange, options):
+        # DVHAccumulator from the dose interpolated at sub-voxel sample points inside the structure.
+        # Each dose slice is split into zSubsampling planes, each voxel into refineDoseMesh^2 points in x/y.
+        # A sampling plane uses the nearest contour plane, within half the contour spacing (or the end capping
+        # beyond the first and last contour). Only the bounding box of each contour plane is rasterized.
+        contourPlanes = self.getContourPlanes(structureName)
+        if not contourPlanes:
+            return DVHAccumulator(doseRange, self.voxelVolume)
+
+        meshFactor = options.refineDoseMesh.get()
+        nSubslices = options.zSubsampling.get()
+        sh = np.shape(self.doseImage)
+        x0, y0, z0 = [float(k) for k in self.rd.ImagePositionPatient]
+        dx, dy = float(self.rd.PixelSpacing[0]), float(self.rd.PixelSpacing[1])
+
+        planeZ = np.array(sorted(contourPlanes))
+        planeSpacing = len(planeZ) > 1 and np.min(np.diff(planeZ)) or self.sliceThickness
+        endCap = {'none' : 0, 'half' : 0.5, 'full' : 1}[options.endCapping.get()] * planeSpacing
+
+        # Sampling planes in the centre of each sub-slice, and the contour plane each of them belongs to
+        sampleZIdx = (np.arange(sh[0] * nSubslices) + 0.5) / nSubslices - 0.5
+        sampleZ = z0 + sampleZIdx * self.sliceThickness
+        nearestPlane = np.argmin(np.abs(sampleZ[:,None] - planeZ[None,:]), axis=1)
+        distance = sampleZ - planeZ[nearestPlane]
+        isInside = np.abs(distance) <= planeSpacing / 2 + 1e-3
+        isInside[sampleZ < planeZ[0]] = planeZ[0] - sampleZ[sampleZ < planeZ[0]] <= endCap + 1e-3
+        isInside[sampleZ > planeZ[-1]] = sampleZ[sampleZ > planeZ[-1]] - planeZ[-1] <= endCap + 1e-3
+
+        sampleVolume = self.voxelVolume / (meshFactor**2 * nSubslices)
+        dvh = DVHAccumulator(doseRange, sampleVolume)
+
+        for planeIdx in np.unique(nearestPlane[isInside]):
+            # Contour points in the refined pixel grid, where refined pixel i has its centre at (i+0.5)/meshFactor-0.5
+            contours = [np.dstack((((c[:,0] - x0) / dx + 0.5) * meshFactor - 0.5,
+                                   ((c[:,1] - y0) / dy + 0.5) * meshFactor - 0.5))[0] for c in contourPlanes[planeZ[planeIdx]]]
+            allPoints = np.vstack(contours)
+            xFrom, yFrom = np.maximum(np.floor(np.min(allPoints, axis=0)).astype(int), 0)
+            xTo = min(int(np.ceil(np.max(allPoints[:,0]))), sh[2]*meshFactor - 1)
+            yTo = min(int(np.ceil(np.max(allPoints[:,1]))), sh[1]*meshFactor - 1)
+            if xTo < xFrom or yTo < yFrom:
+                continue
+
+            linearContour = LinearContour(options)
+            for contour in contours:
+                linearContour.addLines(contour - [xFrom, yFrom])
+            contourMap = linearContour.getListOfPixelsInContour(np.zeros((yTo-yFrom+1, xTo-xFrom+1), dtype="bool"), True)
+
+            yIdx, xIdx = np.nonzero(contourMap)
+            yIdx = (yIdx + yFrom + 0.5) / meshFactor - 0.5
+            xIdx = (xIdx + xFrom + 0.5) / meshFactor - 0.5
+
+            for zIdx in sampleZIdx[isInside & (nearestPlane == planeIdx)]:
+                sampleDose = self.interpolateDose(np.full(np.shape(xIdx), zIdx), yIdx, xIdx)
+                dvh.addSlice(sampleDose)
+
+        return dvh
+
+    def getSlicewiseDVH(self, structureNames, doseRange, options, progress = None):
+        # Returns { structure : (slice x dose bin) array } with the cumulative DVH [mm3] of every dose slice.
+        # The dose grid is read slab by slab, and the doses inside each structure are binned slice by slice into a
+        # (slice x dose bin) count matrix, so that only one slice of doses is kept at a time.
+        nSlices, nBins = np.shape(self.doseImage)[0], len(doseRange)
+        counts = { structure : np.zeros((nSlices, nBins+1), dtype=np.int64) for structure in structureNames }
+
+        for z0, slab in self.getDoseSlabs():
+            for z in range(z0, z0 + len(slab)):
+                if progress:
+                    progress.step(1)
+                    progress.update_idletasks()
+
+                for structure in structureNames:
+                    contours = self.getStructuresInImageCoordinates(structure, z)
+                    if not len(contours[0]):
+                        continue
+
+                    linearContour = LinearContour(options)
+                    for contourX, contourY in zip(*contours):
+                        linearContour.addLines(np.dstack((contourX, contourY))[0])
+                    doseInside = slab[z-z0][linearContour.getListOfPixelsInContour(slab[z-z0])]
+
+                    aboveIdx = np.searchsorted(doseRange, doseInside, side='left')
+                    counts[structure][z] += np.bincount(aboveIdx, minlength=nBins+1)
+
+        slicewiseVolume = dict()
+        for structure in structureNames:
+            volume = counts[structure] * self.voxelVolume
+            slicewiseVolume[structure] = np.cumsum(volume[:,::-1], axis=1)[:,::-1][:,1:]
+
+        return slicewiseVolume
+
+    def getStructureSlices(self, structureName, simplified = True):
+        # Returns { dose slice index : (cListX, cListY) } with the contours of a structure in image coordinates,
+        # for the contours within 0.1 mm of a dose slice. Calculated once per structure. The simplified contours are
+        # rasterized, the original contours are drawn in the viewer.
+        if (structureName, simplified) not in self.structureSlices:
+            structureSlices = dict()
+            z0 = float(self.rd.ImagePositionPatient[2])
+            contours = simplified and self.getSimplifiedContours(structureName) or self.getContours(structureName)
+
+            for contourZ in contours:
+                zIdx = int(round((contourZ[0,2] - z0) / self.sliceThickness))
+                if abs(contourZ[0,2] - (zIdx * self.sliceThickness + z0)) > 0.1: continue
+
+                cListX, cListY = structureSlices.setdefault(zIdx, (list(), list()))
+                cListX.append((contourZ[:,0] - self.rd.ImagePositionPatient[0]) / self.rd.PixelSpacing[0])
+                cListY.append((contourZ[:,1] - self.rd.ImagePositionPatient[1]) / self.rd.PixelSpacing[1])
+
+            self.structureSlices[(structureName, simplified)] = structureSlices
+
+        return self.structureSlices[(structureName, simplified)]
 
     def getStructuresInImageCoordinates(self, structureName, zIdx):
-        cListX, cListY = list(), list()
-        zAbsolute = zIdx * self.sliceThickness + float(self.rd.ImagePositionPatient[2])
-                
-        for contourZ in self.contours[structureName]:
-            if abs(contourZ[0,2] - zAbsolute) > 0.1: continue
-            cListX.append((contourZ[:,0] - self.rd.ImagePositionPatient[0]) / self.rd.PixelSpacing[0])
-            cListY.append((contourZ[:,1] - self.rd.ImagePositionPatient[1]) / self.rd.PixelSpacing[1])
-        
-        return cListX, cListY
+        return self.getStructureSlices(structureName).get(zIdx, (list(), list()))
 
     def getImageDate(self):
         return self.ds[0x8,0x20].value
@@ -914,6 +2446,12 @@ class Series:
     def getDoseImage(self):
         return self.doseImage
 
-root = Tk()
-mainmenu = MainMenu(root)
-root.mainloop()
+    def getDoseSlabs(self):
+        # Yields (first slice index, scaled dose of slabSize slices) over the whole dose grid
+        for z0 in range(0, np.shape(self.doseImage)[0], self.slabSize):
+            yield z0, self.doseImage[z0:z0+self.slabSize]
+
+if __name__ == "__main__":
+    root = Tk()
+    mainmenu = MainMenu(root)
+    root.mainloop()
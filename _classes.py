@@ -2,6 +2,7 @@ import numpy as np
 from matplotlib import pyplot as plt
 import matplotlib.patches as patches
 import pydicom, os
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Line:
@@ -83,6 +84,78 @@ class LinearContour:
 
         return contourMap
 
+def parseContourData(element):
+    # Parse a (3006,0050) ContourData element into an (N, 3) array of x, y, z points [mm], from the raw DS string if possible
+    value = element.value
+    if isinstance(value, bytes):
+        points = np.array(value.rstrip(b'\x00 ').split(b'\\'), dtype=np.float64)
+    else:
+        points = np.array(value, dtype=np.float64)
+
+    return np.reshape(points, (len(points)//3, 3))
+
+def shiftImage(image, offset):
+    # Returns the image moved by whole pixels, out[i + offset] = image[i] along each axis, filled with zeros
+    out = np.zeros_like(image)
+    source, target = list(), list()
+    for n, k in zip(np.shape(image), offset):
+        k = int(k)
+        source.append(slice(max(-k, 0), max(n - k, 0)))
+        target.append(slice(max(k, 0), max(n + k, 0)))
+    out[tuple(target)] = image[tuple(source)]
+
+    return out
+
+class CalibrationCurve:
+    # Piecewise linear HU - RSP calibration curve, given as [HU, RSP] points (constant outside the first / last point).
+    # The curve is tabulated over the integer HU range once, and the lookup tables are shared between instances.
+    lookupTables = dict()
+
+    # Schneider et al., PMB 41(1) (1996): 1.02365 + 0.00100547*HU below 200 HU, 1.06037 + 0.00046761*HU above
+    schneider1996 = [[-1024, 1.02365 - 0.00100547*1024], [199, 1.02365 + 0.00100547*199],
+                     [200, 1.06037 + 0.00046761*200], [3071, 1.06037 + 0.00046761*3071]]
+
+    def __init__(self, points = None, filename = None):
+        if filename:
+            points = self.loadCurve(filename)
+
+        self.points = np.array(self.schneider1996 if points is None else points, dtype=np.float64)
+        self.points = self.points[np.argsort(self.points[:,0], kind='stable')]
+        self.key = tuple(map(tuple, self.points))
+
+    def loadCurve(self, filename):
+        # Text file with one 'HU,RSP' pair per line, e.g. a stoichiometric calibration
+        points = list()
+        with open(filename, "r") as curveFile:
+            for line in curveFile.readlines():
+                linesplit = line.replace(";", ",").split(",")
+                try:
+                    points.append([float(linesplit[0]), float(linesplit[1])])
+                except (ValueError, IndexError):
+                    continue # header or empty line
+
+        return points
+
+    def getLookupTable(self):
+        # Returns the first tabulated HU value and the RSP for every integer HU from there on
+        if self.key not in self.lookupTables:
+            huMin = int(min(np.floor(self.points[0,0]), -1024))
+            huMax = int(max(np.ceil(self.points[-1,0]), 3071))
+            hu = np.arange(huMin, huMax + 1)
+            self.lookupTables[self.key] = [huMin, np.interp(hu, self.points[:,0], self.points[:,1])]
+
+        return self.lookupTables[self.key]
+
+    def convert(self, image, out = None):
+        # One gather from the lookup table for the whole (2D or 3D) HU image, HU outside the table are clamped
+        huMin, table = self.getLookupTable()
+        if out is None or np.shape(out) != np.shape(image):
+            out = np.empty(np.shape(image), dtype=table.dtype)
+
+        np.take(table, np.subtract(image, huMin, dtype=np.int32), mode='clip', out=out)
+
+        return out
+
 class Series:
     def __init__(self, path = None, zpos = None,
                  structure = None, translation = None):
@@ -94,35 +167,117 @@ class Series:
 
         self.rs = None
         self.ds = None
+        self.volume = None
+        self.sliceZ = None
+        self.slicePaths = list()
+        self.sliceUIDs = list()
+        self.sliceShape = None
         self.image = None
+        self.imageRSP = None
         self.imageWEPL = None
         self.contourWEPL = list()
         self.pixelSpacing = None
+        self.sliceThickness = None
         self.imageUID = None
         self.contours = list()
 
-    def loadImages(self):
+    def loadImages(self, nThreads = 8, cacheFile = None):
+        # Loads the whole CT series into self.volume [z,y,x] (HU), indexed by z position.
+        # With zpos set, self.image is that slice, otherwise it is the full volume.
+        # With cacheFile, the volume is assembled in a memory-mapped .npy file instead of in memory.
         fDS, fRS = list(), list()
         for (dirpath, dirnames, filenames) in os.walk(self.path):
             fDS += [os.path.join(dirpath, file) for file in filenames if "CT" in file]
             fRS += [os.path.join(dirpath, file) for file in filenames if "RS" in file]
 
-        DS = [[x, pydicom.dcmread(x, stop_before_pixels=True)] for x in fDS]
-        self.rs = pydicom.dcmread(fRS[0])
+        with ThreadPoolExecutor(nThreads) as executor:
+            self.indexImages(fDS, executor)
+            self.assembleVolume(executor, cacheFile)
+
+        self.ds = pydicom.dcmread(self.slicePaths[0], stop_before_pixels=True)
+        self.pixelSpacing = float(self.ds.PixelSpacing[0])
+        if len(self.sliceZ) > 1:
+            self.sliceThickness = float(np.median(np.diff(self.sliceZ)))
+        else:
+            self.sliceThickness = float(self.ds.get('SliceThickness') or self.pixelSpacing)
 
         if self.zpos:
-            for images in DS:
-                if abs(images[1][0x20,0x32][2] + self.translation[2] - self.zpos) <= 1:
-                    self.ds = pydicom.dcmread(images[0])
-                    break
+            zIdx = self.getSliceIndex(self.zpos - (self.translation and self.translation[2] or 0))
+            if zIdx is None:
+                raise ValueError(f"No CT slice found at z = {self.zpos} mm in {self.path}")
+
+            self.ds = pydicom.dcmread(self.slicePaths[zIdx], stop_before_pixels=True)
+            self.image = self.volume[zIdx]
         else:
-            self.ds = pydicom.dcmread(DS[0][0])
-        
-        self.pixelSpacing = float(self.ds.PixelSpacing[0])
+            self.image = self.volume
+
         self.dicomTranslation = [float(k) for k in self.ds[0x20,0x32]]
         self.imageUID = self.ds[0x8, 0x18].value
-        self.image = np.array(self.ds.pixel_array, dtype='int')
-        self.image += int(self.ds.RescaleIntercept)
+        self.rs = pydicom.dcmread(self.findStructureFile(fRS))
+
+    def indexImages(self, fileList, executor):
+        # Header-only reads of all CT files, sorted by z position
+        headers = list(executor.map(lambda x: pydicom.dcmread(x, stop_before_pixels=True), fileList))
+        index = sorted([[float(ds.ImagePositionPatient[2]), ds.SOPInstanceUID, path, ds] for path, ds in zip(fileList, headers)],
+                       key=lambda k: k[0])
+
+        self.sliceZ = np.array([k[0] for k in index])
+        self.sliceUIDs = [k[1] for k in index]
+        self.slicePaths = [k[2] for k in index]
+        self.sliceShape = (int(index[0][3].Rows), int(index[0][3].Columns))
+
+    def assembleVolume(self, executor, cacheFile = None):
+        # Preallocated (or memory-mapped) int16 HU volume, each slice is decoded and rescaled in place. The rescale is done
+        # in a wider type, and slices with HU values outside the int16 range (e.g. raw uint16 values) raise instead of
+        # wrapping around.
+        sh = (len(self.slicePaths),) + self.sliceShape
+        if cacheFile:
+            self.volume = np.lib.format.open_memmap(cacheFile, mode='w+', dtype=np.int16, shape=sh)
+        else:
+            self.volume = np.empty(sh, dtype=np.int16)
+
+        def readSlice(zIdx):
+            ds = pydicom.dcmread(self.slicePaths[zIdx])
+            slope = float(getattr(ds, 'RescaleSlope', 1) or 1)
+            intercept = float(getattr(ds, 'RescaleIntercept', 0) or 0)
+            if slope == 1 and intercept == int(intercept):
+                hu = np.add(ds.pixel_array, int(intercept), dtype=np.int32)
+            else:
+                hu = np.rint(ds.pixel_array * slope + intercept)
+
+            if hu.min() < np.iinfo(np.int16).min or hu.max() > np.iinfo(np.int16).max:
+                raise ValueError(f"HU values in {self.slicePaths[zIdx]} are outside the int16 range "
+                                 f"({hu.min():.0f} to {hu.max():.0f})")
+            self.volume[zIdx] = hu
+
+        list(executor.map(readSlice, range(sh[0])))
+        if cacheFile:
+            self.volume.flush()
+
+    def getSliceIndex(self, z, tolerance = 1):
+        # Index of the CT slice closest to z [mm] (binary search), or None if none is within tolerance
+        if self.sliceZ is None or not len(self.sliceZ):
+            return None
+
+        zIdx = np.searchsorted(self.sliceZ, z)
+        candidates = [k for k in [zIdx-1, zIdx] if 0 <= k < len(self.sliceZ)]
+        zIdx = min(candidates, key=lambda k: abs(self.sliceZ[k] - z))
+
+        if abs(self.sliceZ[zIdx] - z) > tolerance:
+            return None
+
+        return zIdx
+
+    def findStructureFile(self, fileList):
+        # With several RS files, use the one referencing the frame of reference of the CT series
+        frameOfReference = getattr(self.ds, 'FrameOfReferenceUID', None)
+        for filename in fileList:
+            rs = pydicom.dcmread(filename, specific_tags=[(0x3006,0x10)])
+            for seq in getattr(rs, 'ReferencedFrameOfReferenceSequence', []):
+                if seq.FrameOfReferenceUID == frameOfReference:
+                    return filename
+
+        return fileList[0]
 
     def loadStructures(self):
         contourIdxList = list()
@@ -156,32 +311,197 @@ class Series:
     
         return cListX, cListY
 
-    def convertImageToRSP(self):
-        # HU - RSP calibration (use data from Schneider et al., PMB 41(1) (1996)
-        fHigh = lambda x: 1.06037 + 0.00046761*x
-        fLow  = lambda x: 1.02365 + 0.00100547*x
-        
-        threshold = self.image >= 200
+    def convertImageToRSP(self, calibrationCurve = None):
+        # HU - RSP calibration, by default using data from Schneider et al., PMB 41(1) (1996)
+        # The previous RSP image is reused as output buffer when it has the same shape
+        calibrationCurve = calibrationCurve or CalibrationCurve()
+        self.imageRSP = calibrationCurve.convert(self.image, self.imageRSP)
 
-        self.imageRSP = np.where(threshold, fHigh(self.image), 0) \
-                        + np.where(~threshold, fLow(self.image), 0)
-        
         return self.imageRSP
 
-    def convertImageToWEPL(self):
-        self.imageWEPL = np.zeros(self.image.shape)
-        for x in range(self.image.shape[0]):
-            self.imageWEPL[:,x] = self.imageRSP[:,x] * self.pixelSpacing
-            if x > 0: self.imageWEPL[:,x] += self.imageWEPL[:,x-1]
+    def getBeamDirection(self, gantryAngle, couchAngle):
+        # Unit vector (x, y, z) of the beam in patient coordinates, IEC 61217 angles [deg] and a head first supine patient
+        gantry, couch = np.radians(gantryAngle), np.radians(couchAngle)
+        return np.array([-np.sin(gantry) * np.cos(couch), np.cos(gantry), np.sin(gantry) * np.sin(couch)])
 
+    def convertImageToWEPL(self, gantryAngle = 270, couchAngle = 0, raysPerVoxel = 8):
+        # Per-voxel WEPL [mm] (up to and including each voxel) for a parallel beam, on a single slice or a 3D volume.
+        # The default gantry angle gives a beam along +x, i.e. accumulated over the image columns. Oblique beams are ray
+        # traced, see traceObliqueWEPL().
+        rsp = self.imageRSP if np.ndim(self.imageRSP) == 3 else self.imageRSP[None]
+        voxelSize = np.array([self.sliceThickness or self.pixelSpacing, self.pixelSpacing, self.pixelSpacing])
+        direction = self.getBeamDirection(gantryAngle, couchAngle)[::-1] # z, y, x as the image axes
+
+        if rsp.shape[0] == 1: # no out-of-plane component on a single slice
+            direction[0] = 0
+            direction /= np.linalg.norm(direction)
+
+        # March slice by slice along the axis closest to the beam, in the beam direction
+        axis = np.argmax(np.abs(direction))
+        step = direction / abs(direction[axis]) * voxelSize[axis] # [mm] from one slice to the next
+        pathLength = np.linalg.norm(step)
+        shift = np.delete(step / voxelSize, axis) # lateral displacement per slice [voxels]
+
+        rsp = np.moveaxis(rsp, axis, 0)
+        if direction[axis] < 0:
+            rsp = rsp[::-1]
+
+        if np.allclose(shift, 0):
+            wepl = np.cumsum(rsp, axis=0) * pathLength
+        else:
+            wepl = self.traceObliqueWEPL(rsp, shift, pathLength, raysPerVoxel)
+
+        if direction[axis] < 0:
+            wepl = wepl[::-1]
+        wepl = np.moveaxis(wepl, 0, axis)
+
+        self.imageWEPL = np.reshape(wepl, np.shape(self.imageRSP))
         return self.imageWEPL
 
+    def traceObliqueWEPL(self, rsp, shift, pathLength, raysPerVoxel = 8):
+        # Siddon ray trace of parallel rays: between the boundary planes of a slice, a ray moves by shift [voxels] and
+        # adds the RSP of each voxel it passes times the path length inside that voxel.
+        # The rays of a family cross every slice at the same fractional offset from the voxel grid, so the path lengths
+        # are the same for all rays of the family in a slice, and a ray is followed from slice to slice by whole-voxel
+        # shifts: the WEPL itself is never interpolated between rays. Each slice takes the WEPL from the family passing
+        # closest to its voxel centres, within 1 / (2 raysPerVoxel) voxel (exactly through them for a lateral axis
+        # without shift). Rays enter the volume with zero WEPL.
+        n, sh = np.shape(rsp)[0], np.shape(rsp)[1:]
+        nFamilies = [ abs(k) > 1e-9 and raysPerVoxel or 1 for k in shift ]
+        steps = np.arange(n)[:,None] * np.array(shift)[None,:]
+
+        # The family of each slice, with its ray offset nearest to the voxel centres
+        family = np.rint(np.mod(-steps, 1) * nFamilies).astype(int) % nFamilies
+        pad = int(np.ceil(np.max(np.abs(shift)) / 2)) + 2 # air around the slices, for the voxels a ray passes
+        paddedRSP = np.pad(rsp, [(0, 0), (pad, pad), (pad, pad)])
+
+        wepl = np.empty(np.shape(rsp))
+        for familyIdx in set(map(tuple, family)):
+            slices = np.flatnonzero(np.all(family == familyIdx, axis=1))
+            offset = np.mod(np.array(familyIdx) / nFamilies + steps[:slices[-1]+1], 1) # [0, 1) voxels, per slice
+
+            # rays[p] is the WEPL of the ray crossing the centre plane of slice k at p - 1 + offset[k], for p = 0 ... sh
+            rays = np.zeros((sh[0] + 1, sh[1] + 1))
+            for k in range(slices[-1] + 1):
+                if k:
+                    rays = shiftImage(rays, np.rint(offset[k-1] + shift - offset[k]))
+
+                # Path fractions between the voxel boundaries (at half-integer positions) crossed within the slice
+                t = [0, 1]
+                for a in range(2):
+                    if nFamilies[a] > 1:
+                        start, end = sorted([offset[k][a] - shift[a] / 2, offset[k][a] + shift[a] / 2])
+                        edges = np.arange(np.ceil(start - 0.5), end - 0.5) + 0.5
+                        t += [ (edge - offset[k][a]) / shift[a] + 0.5 for edge in edges ]
+                t = np.unique(np.clip(t, 0, 1))
+
+                for t0, t1 in zip(t[:-1], t[1:]):
+                    row0, col0 = np.floor(offset[k] + np.array(shift) * ((t0 + t1) / 2 - 0.5) + 0.5).astype(int) + pad - 1
+                    rays += (t1 - t0) * pathLength * paddedRSP[k, row0:row0+sh[0]+1, col0:col0+sh[1]+1]
+
+                if familyIdx == tuple(family[k]):
+                    row0, col0 = 1 - np.rint(offset[k]).astype(int) # offset close to 1: the ray of the previous index
+                    wepl[k] = rays[row0:row0+sh[0], col0:col0+sh[1]]
+
+        return wepl
+
     def createWEPLcurve(self):
-        for contourX, contourY in zip(*self.getStructuresInImageCoordinates()):
-            for xi, yi in zip(contourX, contourY):
-                self.contourWEPL.append(self.imageWEPL[int(yi), int(xi)])
+        # WEPL at the contour points of the selected structure on the selected slice (bilinear interpolation)
+        for contour in self.contours:
+            self.contourWEPL += list(self.interpolateImage(self.imageWEPL, *self.getImageIndices(contour)))
 
         return self.contourWEPL
 
+    def getContourPoints(self, structures = None):
+        # Returns { structure name : (N, 3) array with all its contour points [mm] }, for all structures by default
+        roiNames = dict()
+        for seq in self.rs.StructureSetROISequence:
+            roiNames[seq[0x3006, 0x22].value] = seq[0x3006, 0x26].value
+
+        contourPoints = dict()
+        for seq in self.rs.ROIContourSequence:
+            structureName = roiNames.get(seq.ReferencedROINumber)
+            if structures and structureName not in structures:
+                continue
+
+            if 'ContourSequence' in seq:
+                contourPoints.setdefault(structureName, list()).extend(
+                    [ parseContourData(cont.get_item(0x30060050)) for cont in seq.ContourSequence ])
+
+        return { k : np.vstack(v) for k, v in contourPoints.items() if v }
+
+    def getImageIndices(self, points):
+        # Fractional (z, y, x) indices in self.image of (N, 3) points [mm]. z is relative to the selected slice for 2D images.
+        zIdx = (points[:,2] - self.dicomTranslation[2]) / self.sliceThickness
+        yIdx = (points[:,1] - self.dicomTranslation[1]) / self.pixelSpacing
+        xIdx = (points[:,0] - self.dicomTranslation[0]) / self.pixelSpacing
+
+        return zIdx, yIdx, xIdx
+
+    def interpolateImage(self, image, zIdx, yIdx, xIdx):
+        # Bilinear interpolation in the image plane, on the nearest slice for a 3D image. NaN outside the image.
+        image = image if np.ndim(image) == 3 else image[None]
+        sh = np.shape(image)
+
+        zIdx = np.rint(zIdx).astype(int)
+        isOutside = (zIdx < 0) | (zIdx >= sh[0]) | (yIdx < 0) | (yIdx > sh[1]-1) | (xIdx < 0) | (xIdx > sh[2]-1)
+        zIdx = np.clip(zIdx, 0, sh[0]-1)
+        yIdx, xIdx = np.clip(yIdx, 0, sh[1]-1), np.clip(xIdx, 0, sh[2]-1)
+
+        y0 = np.minimum(np.floor(yIdx).astype(int), max(sh[1]-2, 0))
+        x0 = np.minimum(np.floor(xIdx).astype(int), max(sh[2]-2, 0))
+        y1, x1 = np.minimum(y0+1, sh[1]-1), np.minimum(x0+1, sh[2]-1)
+        fy, fx = yIdx - y0, xIdx - x0
+
+        values = (1-fy) * (1-fx) * image[zIdx, y0, x0] + (1-fy) * fx * image[zIdx, y0, x1] \
+                 + fy * (1-fx) * image[zIdx, y1, x0] + fy * fx * image[zIdx, y1, x1]
+
+        return np.where(isOutside, np.nan, values)
+
+    def sampleContours(self, structures = None):
+        # Samples WEPL, RSP and HU (those that are calculated) at all contour points of all structures at once.
+        # Returns { structure name : { 'points' : (N, 3) [mm], 'WEPL' : (N,), 'RSP' : (N,), 'HU' : (N,) } }
+        contourPoints = self.getContourPoints(structures)
+        if not contourPoints:
+            return dict()
+
+        names = list(contourPoints.keys())
+        allPoints = np.vstack([contourPoints[k] for k in names])
+        splitIdx = np.cumsum([len(contourPoints[k]) for k in names])[:-1]
+        indices = self.getImageIndices(allPoints)
+
+        samples = { k : { 'points' : contourPoints[k] } for k in names }
+        for quantity, image in [['WEPL', self.imageWEPL], ['RSP', self.imageRSP], ['HU', self.image]]:
+            if image is None:
+                continue
+
+            values = np.split(self.interpolateImage(image, *indices), splitIdx)
+            for name, value in zip(names, values):
+                samples[name][quantity] = value
+
+        return samples
+
+    def getContourStatistics(self, samples):
+        # Summary statistics of sampleContours() output, ignoring points outside the image:
+        # { structure name : { quantity : { 'n', 'mean', 'std', 'min', 'p5', 'median', 'p95', 'max' } } }
+        statistics = dict()
+        for name, sample in samples.items():
+            statistics[name] = dict()
+            for quantity, values in sample.items():
+                if quantity == 'points':
+                    continue
+
+                values = values[~np.isnan(values)]
+                if not len(values):
+                    statistics[name][quantity] = { 'n' : 0 }
+                    continue
+
+                p5, median, p95 = np.percentile(values, [5, 50, 95])
+                statistics[name][quantity] = { 'n' : len(values), 'mean' : np.mean(values), 'std' : np.std(values),
+                                               'min' : np.min(values), 'p5' : p5, 'median' : median, 'p95' : p95,
+                                               'max' : np.max(values) }
+
+        return statistics
+
     def getImageDate(self):
         return self.ds[0x8,0x20].value            
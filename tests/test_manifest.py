@@ -0,0 +1,66 @@
+import importlib.util
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("tkinter")
+
+scriptPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dose RT to DVH.py")
+spec = importlib.util.spec_from_file_location("doseRTtoDVH", scriptPath)
+doseRTtoDVH = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(doseRTtoDVH)
+
+
+def makeStaleLock(manifest, age = 3600):
+    with open(manifest.lockFilename, "w") as lockFile:
+        lockFile.write("[\"crashed\", 0]")
+    os.utime(manifest.lockFilename, (time.time() - age, time.time() - age))
+
+
+def test_stale_lock_is_taken_once(tmp_path):
+    # Workers that all find the same stale lock: only one of them may remove it, the others must then wait for the
+    # lock of that worker instead of removing it as well
+    manifest = doseRTtoDVH.JobManifest(str(tmp_path / "manifest.json"), str(tmp_path), {})
+    makeStaleLock(manifest)
+    start = threading.Barrier(8)
+    holders = list()
+    overlaps = list()
+    errors = list()
+
+    def worker():
+        try:
+            start.wait()
+            for k in range(5):
+                manifest.lock(timeout = 1)
+                holders.append(threading.get_ident())
+                if len(holders) > 1:
+                    overlaps.append(list(holders))
+                time.sleep(0.01)
+                holders.remove(threading.get_ident())
+                manifest.unlock()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [ threading.Thread(target=worker) for k in range(8) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+
+    assert not errors
+    assert not overlaps
+    assert not os.path.exists(manifest.lockFilename)
+    assert [ k for k in os.listdir(tmp_path) if k.endswith(".stale") ] == []
+
+
+def test_unlock_without_lock(tmp_path):
+    manifest = doseRTtoDVH.JobManifest(str(tmp_path / "manifest.json"), str(tmp_path), {})
+    makeStaleLock(manifest)
+
+    manifest.lock()
+    os.remove(manifest.lockFilename)
+    manifest.unlock()
+
+    assert manifest.update(lambda jobs: len(jobs)) == 0
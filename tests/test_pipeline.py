@@ -0,0 +1,66 @@
+import importlib.util
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("tkinter")
+
+scriptPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dose RT to DVH.py")
+spec = importlib.util.spec_from_file_location("doseRTtoDVH", scriptPath)
+doseRTtoDVH = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(doseRTtoDVH)
+
+
+def runWithTimeout(pipeline, items, timeout = 10):
+    # Runs the pipeline in a thread, returns its results or None if it did not finish within timeout [s]
+    results = list()
+    thread = threading.Thread(target=lambda: results.append(pipeline.run(items)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if not results:
+        return None
+    return results[0]
+
+
+def load(item):
+    if item % 3 == 0:
+        raise ValueError(f"bad read {item}")
+    return item
+
+
+def calculate(item, loaded):
+    if item % 5 == 0:
+        raise ValueError(f"bad calculation {item}")
+    return loaded * 2
+
+
+def write(item, result):
+    if item % 7 == 0:
+        raise ValueError(f"bad write {item}")
+    return result
+
+
+def failAndRaise(item, error):
+    raise OSError(f"manifest not writable ({error})")
+
+
+@pytest.mark.parametrize("readerThreads", [0, 1, 3])
+def test_failing_fail_does_not_hang(readerThreads):
+    items = list(range(1, 30))
+    pipeline = doseRTtoDVH.Pipeline(load, calculate, write, failAndRaise, readerThreads, prefetchDepth=1, writeDepth=1)
+
+    results = runWithTimeout(pipeline, items)
+
+    assert results is not None, "the pipeline hangs"
+    assert sorted(results) == [ 2 * k for k in items if k % 3 and k % 5 and k % 7 ]
+
+
+def test_failures_are_reported():
+    failed = list()
+    pipeline = doseRTtoDVH.Pipeline(load, calculate, write, lambda item, error: failed.append(item), 2)
+
+    results = runWithTimeout(pipeline, list(range(1, 30)))
+
+    assert len(results) + len(failed) == 29
+    assert sorted(failed) == [ k for k in range(1, 30) if not (k % 3 and k % 5 and k % 7) ]
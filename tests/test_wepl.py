@@ -0,0 +1,69 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import _classes
+
+
+def referenceWEPL(rsp, voxelSize, direction, index, axis, step=0.02):
+    # Fine-step ray march [mm] through the voxelized (piecewise constant) RSP, from the downstream boundary plane of
+    # the voxel at index along the marching axis, back to where the ray leaves the volume
+    point = np.array(index, dtype=float) * voxelSize + direction * 0.5 * voxelSize[axis] / abs(direction[axis])
+    wepl = 0
+    while True:
+        voxel = np.floor(point / voxelSize + 0.5).astype(int)
+        if np.any(voxel < 0) or np.any(voxel >= np.shape(rsp)):
+            return wepl
+        wepl += rsp[tuple(voxel)] * step
+        point -= direction * step
+
+
+def makeRod(shape, voxelSize, direction, width, rspRod = 2.0):
+    # RSP 1 with a rod of rspRod through the centre of the volume, parallel to direction (z, y, x)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing='ij'), -1) * voxelSize
+    relative = grid - (np.array(shape) - 1) / 2 * voxelSize
+    lateral = relative - np.dot(relative, direction)[..., None] * direction
+    return np.where(np.linalg.norm(lateral, axis=-1) <= width / 2, rspRod, 1.0)
+
+
+@pytest.mark.parametrize("width", [5, 2])
+def test_oblique_wepl_along_rod_in_slice(width):
+    series = _classes.Series()
+    series.pixelSpacing, series.sliceThickness = 1.0, 1.0
+    direction = series.getBeamDirection(290, 0)[::-1]
+    rsp = makeRod((1, 200, 200), np.ones(3), direction, width)
+    series.imageRSP = rsp[0]
+
+    wepl = series.convertImageToWEPL(290, 0)
+
+    # 80 mm downstream of the centre, inside the rod
+    index = np.rint((np.array([0, 200, 200]) - 1) / 2 + [0, 80 * direction[1], 80 * direction[2]]).astype(int)
+    reference = referenceWEPL(rsp, np.ones(3), direction, index, np.argmax(np.abs(direction)))
+    assert wepl[index[1], index[2]] == pytest.approx(reference, rel=0.01)
+
+
+def test_oblique_wepl_along_rod_in_volume():
+    series = _classes.Series()
+    series.pixelSpacing, series.sliceThickness = 1.0, 1.0
+    direction = series.getBeamDirection(290, 30)[::-1]
+    rsp = makeRod((100, 200, 200), np.ones(3), direction, 4)
+    series.imageRSP = rsp
+
+    wepl = series.convertImageToWEPL(290, 30)
+
+    index = np.rint((np.array(rsp.shape) - 1) / 2 + 80 * direction).astype(int)
+    reference = referenceWEPL(rsp, np.ones(3), direction, index, np.argmax(np.abs(direction)))
+    assert wepl[tuple(index)] == pytest.approx(reference, rel=0.01)
+
+
+def test_axis_aligned_wepl():
+    series = _classes.Series()
+    series.pixelSpacing, series.sliceThickness = 2.0, 3.0
+    series.imageRSP = np.random.default_rng(0).uniform(0.5, 1.5, (30, 30))
+
+    wepl = series.convertImageToWEPL(270, 0)
+
+    assert np.allclose(wepl, np.cumsum(series.imageRSP, axis=1) * 2.0)